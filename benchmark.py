@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys, os, math, random, time
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+
+import gpx2ps
+
+# Generates a synthetic corpus of GPX files and times each stage of the
+# gpx2ps pipeline on it, once for each of the --autofit, --bbox, --center
+# and --tiles modes.  Results are written as JSON so that runs against
+# different versions of gpx2ps can be compared.
+#
+# Examples
+# ./benchmark.py > results.json
+# ./benchmark.py --files 2000 --points 500 --spread 2.0 --repeat 5 --label before > before.json
+# ./benchmark.py --corpusdir /tmp/corpus --keepcorpus --modes autofit,tiles
+
+MODES = ("autofit", "bbox", "center", "tiles")
+
+def main():
+  parser = argparse.ArgumentParser(description="Time the gpx2ps pipeline on synthetic GPX files")
+  parser.add_argument("--files", dest="files", action="store", type=int, default=200,
+                      help="Number of GPX files to generate.  Default: 200")
+  parser.add_argument("--tracks", dest="tracks", action="store", type=int, default=1,
+                      help="Tracks per file.  Default: 1")
+  parser.add_argument("--segments", dest="segments", action="store", type=int, default=2,
+                      help="Segments per track.  Default: 2")
+  parser.add_argument("--points", dest="points", action="store", type=int, default=1000,
+                      help="Points per segment.  Default: 1000")
+  parser.add_argument("--center", dest="center", action="store", metavar="LAT,LON",
+                      default="47.604815,-122.287016",
+                      help="Middle of the area the tracks are spread over")
+  parser.add_argument("--spread", dest="spread", action="store", type=float, default=0.5,
+                      help="Width in degrees of the area the tracks start in.  Default: 0.5")
+  parser.add_argument("--seed", dest="seed", action="store", type=int, default=1,
+                      help="Random seed for the generated tracks.  Default: 1")
+  parser.add_argument("--corpusdir", dest="corpusdir", action="store",
+                      help="Directory to generate the corpus in.  Default: a temporary directory")
+  parser.add_argument("--keepcorpus", dest="keepcorpus", action="store_true",
+                      help="Don't delete the corpus when done")
+  parser.add_argument("--modes", dest="modes", action="store", default=",".join(MODES),
+                      help="Comma separated list of modes to time.  Default: %s" % ",".join(MODES))
+  parser.add_argument("--repeat", dest="repeat", action="store", type=int, default=3,
+                      help="Number of times to run each stage; the fastest is reported.  Default: 3")
+  parser.add_argument("--script", dest="script", action="store",
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "gpx2ps.py"),
+                      help="gpx2ps script to run for the end to end timings")
+  parser.add_argument("--label", dest="label", action="store",
+                      help="Label to store with the results, such as a version")
+  parser.add_argument("--output", dest="output", action="store",
+                      help="File to write the JSON results to.  Default: standard output")
+  args = parser.parse_args()
+
+  modes = args.modes.split(",")
+  for mode in modes:
+    if mode not in MODES:
+      sys.stderr.write("Error: unknown mode '%s'\n" % mode)
+      sys.exit(1)
+  if args.repeat < 1:
+    sys.stderr.write("Error: --repeat must be at least 1\n")
+    sys.exit(1)
+  centerlat, centerlon = map(float, args.center.split(","))
+
+  if args.corpusdir != None:
+    corpusdir = args.corpusdir
+    if not os.path.isdir(corpusdir):
+      os.makedirs(corpusdir)
+  else:
+    corpusdir = tempfile.mkdtemp(prefix="gpx2ps-bench")
+
+  try:
+    corpus = writecorpus(corpusdir, args.files, args.tracks, args.segments, args.points,
+                         centerlat, centerlon, args.spread, args.seed)
+    inputfiles = gpx2ps.sortedanum([os.path.join(corpusdir, name) for name in corpus["names"]])
+    del corpus["names"]
+
+    results = {
+      "label": args.label,
+      "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "numpy": gpx2ps.numpy is not None,
+      "repeat": args.repeat,
+      "corpus": corpus,
+      "modes": {},
+    }
+    for mode in modes:
+      results["modes"][mode] = timemode(mode, inputfiles, corpusdir, centerlat, centerlon,
+                                        args.spread, args.repeat, args.script)
+  finally:
+    if not args.keepcorpus:
+      shutil.rmtree(corpusdir, ignore_errors=True)
+
+  if args.output != None:
+    outfile = open(args.output, "w")
+  else:
+    outfile = sys.stdout
+  json.dump(results, outfile, indent=2, sort_keys=True)
+  outfile.write("\n")
+  if outfile is not sys.stdout:
+    outfile.close()
+
+
+##
+## writecorpus()
+## Write files full of random walk tracks, starting at random places within
+## spread degrees of the center.  Returns a description of the corpus
+##
+def writecorpus(directory, files, tracks, segments, points, centerlat, centerlon, spread, seed):
+  rng = random.Random(seed)
+  names = []
+  totalbytes = 0
+  for filenum in range(files):
+    lat = centerlat + rng.uniform(-spread/2.0, spread/2.0)
+    lon = centerlon + rng.uniform(-spread/2.0, spread/2.0)
+    start = 1262304000 + filenum * 86400    # one track a day from 2010-01-01
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<gpx version="1.1" creator="gpx2ps benchmark" xmlns="http://www.topografix.com/GPX/1/1">',
+             '<metadata><time>%s</time></metadata>' % isotime(start)]
+    for tracknum in range(tracks):
+      lines.append('<trk><name>Track %d-%d</name><type>cycling</type>' % (filenum, tracknum))
+      for segmentnum in range(segments):
+        lines.append('<trkseg>')
+        heading = rng.uniform(0, 2*math.pi)
+        for pointnum in range(points):
+          heading += rng.gauss(0, 0.3)
+          lat += 0.0001 * math.cos(heading)
+          lon += 0.0001 * math.sin(heading) / math.cos(math.radians(lat))
+          lines.append('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time></trkpt>' %
+                       (lat, lon, 100 + 10*math.sin(pointnum/50.0), isotime(start + pointnum)))
+        lines.append('</trkseg>')
+      lines.append('</trk>')
+    lines.append('</gpx>')
+
+    name = "track%d.gpx" % filenum
+    with open(os.path.join(directory, name), "w") as outfile:
+      outfile.write("\n".join(lines))
+      outfile.write("\n")
+    totalbytes += os.path.getsize(os.path.join(directory, name))
+    names.append(name)
+
+  return {"names": names, "files": files, "tracks": tracks, "segments": segments,
+          "points": points, "totalpoints": files * tracks * segments * points,
+          "center": [centerlat, centerlon], "spread": spread, "seed": seed,
+          "bytes": totalbytes}
+
+def isotime(seconds):
+  return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+##
+## timemode()
+## Time each stage of the pipeline for one mode
+##
+def timemode(mode, inputfiles, corpusdir, centerlat, centerlon, spread, repeat, script):
+  timings = {}
+
+  # Parse: read and pack every file
+  parsed = best(repeat, lambda: list(gpx2ps.readfiles(inputfiles)), timings, "parse")
+
+  # Autofit bounds: collect the packed files and find their bounds
+  store = best(repeat, lambda: fillstore(parsed), timings, "bounds")
+  store.close()
+
+  gpxs = [gpx2ps.unpackgpx(packed) for inputfile, packed in parsed]
+  papersize = (612, 792)
+  views = []         # (view, xoffset, yoffset, segments)
+  clippedviews = []  # the same with --clip
+  if mode == "tiles":
+    ntracks = sum(len(gpx) for gpx in gpxs)
+    xtiles, ytiles = gpx2ps.tile(ntracks, papersize[1], papersize[0])
+    xoffset = 0
+    yoffset = 1 - ytiles
+    for gpx in gpxs:
+      for track in gpx:
+        minlat, minlon, maxlat, maxlon = trackbounds(track)
+        for clip, viewlist in ((False, views), (True, clippedviews)):
+          view = gpx2ps.View(gpx2ps.PROJECTIONS["equirectangular"], minlat + (maxlat - minlat)/2.0,
+                             minlon + (maxlon - minlon)/2.0, minlat, minlon, maxlat, maxlon,
+                             2, papersize, xtiles, ytiles, 100, clip=clip)
+          viewlist.append((view, xoffset, yoffset, list(track)))
+        xoffset += 1
+        if xoffset >= xtiles:
+          xoffset = 0
+          yoffset += 1
+  else:
+    # The view is worked out as gpx2ps does it, widened to the shape of the paper
+    if mode == "autofit":
+      settings = {"autofit": True}
+    elif mode == "bbox":
+      # The middle half of the area the tracks start in
+      minlat, minlon = centerlat - spread/4.0, centerlon - spread/4.0
+      maxlat, maxlon = centerlat + spread/4.0, centerlon + spread/4.0
+      settings = {"bbox": "%f,%f,%f,%f" % (minlat, minlon, maxlat, maxlon)}
+    else:
+      radius = spread/4.0 * 111.0    # kilometers
+      settings = {"center": "%f,%f" % (centerlat, centerlon), "radius": "%fkm" % radius}
+    segments = [segment for gpx in gpxs for track in gpx for segment in track]
+    for clip, viewlist in ((False, views), (True, clippedviews)):
+      view = gpx2ps.makeview(gpx2ps.options(clip=clip, **settings), store.bounds, 0)
+      viewlist.append((view, 0, 0, segments))
+
+  # Insidebox: the bounding box test for every point, which decides what is
+  # drawn without --clip
+  def insidebox():
+    return [[gpx2ps.insidebox(segment, view) for segment in segments]
+            for view, xoffset, yoffset, segments in views]
+  inside = best(repeat, insidebox, timings, "insidebox")
+
+  # Project: projection and scaling of every segment with a point on the map
+  def project():
+    for (view, xoffset, yoffset, segments), segmentsinside in zip(views, inside):
+      for segment, pointsinside in zip(segments, segmentsinside):
+        if any(pointsinside[1:]):
+          gpx2ps.projectsegment(segment, view, xoffset, yoffset)
+  best(repeat, project, timings, "project")
+
+  # Draw: the bounding box test, projection and formatting together, as
+  # drawsegment() does them
+  def draw(views):
+    out = []
+    for view, xoffset, yoffset, segments in views:
+      for segment in segments:
+        gpx2ps.drawsegment(segment, view, xoffset, yoffset, out)
+    return out
+  out = best(repeat, lambda: draw(views), timings, "draw")
+
+  # Clipdraw: drawing with --clip, where lines are cut off at the edge of
+  # the map with outcodes and liangbarsky() instead
+  best(repeat, lambda: draw(clippedviews), timings, "clipdraw")
+
+  # Write: joining and writing out the postscript
+  def write():
+    with open(os.devnull, "w") as outfile:
+      outfile.write("".join(out))
+  best(repeat, write, timings, "write")
+  timings["bytes"] = sum(len(text) for text in out)
+
+  # End to end: the whole script, run the way a user would
+  if mode == "tiles":
+    modeargs = ["--tiles"]
+  else:
+    modeargs = []
+    for key, value in sorted(settings.items()):
+      modeargs += ["--" + key] if value is True else ["--" + key, value]
+  command = [sys.executable, script, "--inputdir", corpusdir] + modeargs
+  def endtoend():
+    with open(os.devnull, "w") as devnull:
+      subprocess.check_call(command, stdout=devnull)
+  best(repeat, endtoend, timings, "endtoend")
+
+  return timings
+
+def fillstore(parsed):
+  store = gpx2ps.PointStore(1 << 62)
+  for inputfile, packed in parsed:
+    store.add(inputfile, packed)
+  return store
+
+
+##
+## trackbounds()
+## Find the minimum and maximum lat/lon of a track
+##
+def trackbounds(track):
+  minlat = 500
+  minlon = 500
+  maxlat = -500
+  maxlon = -500
+  for segment in track:
+    if len(segment) > 0:
+      bounds = gpx2ps.pointbounds(segment.coords, segment.start, len(segment))
+      minlat = min(minlat, bounds[0])
+      minlon = min(minlon, bounds[1])
+      maxlat = max(maxlat, bounds[2])
+      maxlon = max(maxlon, bounds[3])
+  return (minlat, minlon, maxlat, maxlon)
+
+
+##
+## best()
+## Run func repeat times, storing the fastest wall clock time in
+## timings[name].  Returns the result of the last run
+##
+def best(repeat, func, timings, name):
+  fastest = None
+  for i in range(repeat):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    if fastest is None or elapsed < fastest:
+      fastest = elapsed
+  timings[name] = fastest
+  return result
+
+
+if __name__ == "__main__":
+  main()
@@ -2,14 +2,41 @@
 
 from __future__ import print_function
 
-import xml.etree.ElementTree as elementtree
-import sys, os, math, re, glob
+from xml.parsers import expat
+import sys, os, math, re
 import argparse
 import json
+import io
+import locale
+import csv
+import array
+import tempfile
+import collections
+import multiprocessing
+import time
+import cProfile
+import functools
+import hashlib
+import struct
+import base64
+import zlib
+import calendar
+import fnmatch
+import asyncio
+import concurrent.futures
+import urllib.parse
+import socket
+import gzip
+import bz2
+import zipfile
+import queue
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # To do
-# - specify date range
-# - specify output file on command line (default to sys.stdout)
 # - specify projection on command line
 # - if line length is over a limit, use moveto instead of lineto
 # - put a logo on the page (command line option for .eps file?)
@@ -31,12 +58,133 @@ def main():
   #lambertazimuthal(0.0, 0.0, 0.0, 180.0) # FIXME: this one causes a divide by zero error
   #sys.exit(1)
 
-  parser = argparse.ArgumentParser(description="In goes the GPX, out goes the PS")
+  parser = makeparser()
+  args = parser.parse_args()
+
+  if args.replicate != None:
+    foundargs = False
+    try:
+      infile = open(args.replicate, "rb")
+    except IOError as detail:
+      sys.stderr.write("Error: " + str(detail) + "\n")
+      sys.exit(1)
+    for line in infile:
+      if line.startswith(b"% argumentlist "):
+        foundargs = True
+        break
+    infile.close()
+
+    if not foundargs:
+        sys.stderr.write("Error: no argument line found\n")
+        exit(1)
+
+    argumentlist = line[15:].decode(locale.getpreferredencoding(False))
+    arguments = json.loads(argumentlist)
+    args = replicateargs(parser, arguments, args)
+
+  if args.profile != None:
+    profiler = cProfile.Profile()
+    profiler.enable()
+  STATS.enabled = args.stats or args.statsjson != None
+  STATS.start()
+
+  try:
+    run(parser, args, commandline)
+  except Gpx2psError as detail:
+    sys.stderr.write("Error: " + str(detail) + "\n")
+    sys.exit(1)
+
+  STATS.stop()
+  if args.stats == True:
+    STATS.report(sys.stderr)
+  if args.statsjson != None:
+    try:
+      with open(args.statsjson, "w") as statsfile:
+        json.dump(STATS.asdict(), statsfile, indent=2, sort_keys=True)
+    except (IOError, OSError) as detail:
+      sys.stderr.write("Error: " + str(detail) + "\n")
+      sys.exit(1)
+
+  if args.profile != None:
+    profiler.disable()
+    profiler.dump_stats(args.profile)
+
+
+##
+## replicateargs()
+## Turn the settings from the "% argumentlist" line of a previous output back
+## into arguments.  The RUNOPTIONS, which say where the output goes and how
+## the work is done rather than what the map looks like, are kept from args
+##
+RUNOPTIONS = ("output", "format", "jobs", "cachedir", "cachesize", "storelimit", "index",
+              "stats", "statsjson", "profile", "serve", "reload")
+
+def replicateargs(parser, arguments, args):
+  newargv = []
+  for key in arguments:
+    if key in RUNOPTIONS:
+      continue
+    if arguments[key] is False or arguments[key] is None:
+      continue
+    if arguments[key] is True:
+      newargv.append("--" + key)
+    elif key == "orientation":  # Hacky: "--landscape" and "--portait" end up in the "orientation" variable
+      newargv.append("--" + arguments[key])
+    else:
+      # --key=value, so that values such as negative latitudes aren't taken for options
+      newargv.append("--%s=%s" % (key, arguments[key]))
+  newargs = parser.parse_args(newargv)
+  # Values go back in as they were rather than as parsed, so a default
+  # linewidth of 0 doesn't come back as 0.0
+  for key in arguments:
+    if hasattr(newargs, key) and key not in RUNOPTIONS:
+      setattr(newargs, key, arguments[key])
+  for key in RUNOPTIONS:
+    setattr(newargs, key, getattr(args, key))
+  return newargs
+
+
+##
+## makeparser()
+## Build the command line parser.  Its defaults are also the defaults for
+## options().  With raiseerrors, a bad option raises Gpx2psError instead of
+## printing the usage and exiting, for options that come from a --views
+## entry or a --serve request rather than the command line
+##
+class ViewParser(argparse.ArgumentParser):
+  def error(self, message):
+    raise Gpx2psError(message)
+
+def makeparser(raiseerrors=False):
+  parsertype = ViewParser if raiseerrors else argparse.ArgumentParser
+  parser = parsertype(description="In goes the GPX, out goes the PS")
   boxgroup = parser.add_mutually_exclusive_group()
   parser.add_argument("--replicate", dest="replicate", action="store",
                       help="Use settings stored in a previously generated .ps file")
   parser.add_argument("--inputdir", dest="inputdir", action="store", default=".",
-                      help="Directory that contains gpx files")
+                      help="Directory that contains gpx files.  Files ending in .gpx.gz or .gpx.bz2, and the gpx files in .zip archives, are read too without being unpacked first")
+  parser.add_argument("--recursive", dest="recursive", action="store_true",
+                      help="Also read the gpx files in subdirectories of --inputdir")
+  parser.add_argument("--output", dest="output", action="store",
+                      help="File to write the postscript to.  Default: standard output")
+  parser.add_argument("--format", dest="format", action="store", choices=("ps", "pdf"), default="ps",
+                      help="Write postscript or PDF.  PDF pages are compressed as they are written.  A PDF title can only use the standard Helvetica and Courier fonts, and Helvetica-Light is drawn as Helvetica.  Default: ps")
+  parser.add_argument("--incremental", dest="incremental", action="store", metavar="PREVIOUS",
+                      help="Bring PREVIOUS, an earlier postscript output of gpx2ps, up to date, drawing only the files that are new or have changed since it was written.  The settings and map area are taken from PREVIOUS, so new tracks outside of it are cut off.  Can't be used with --tiles, --views, --raster, --dedup or --format pdf")
+  parser.add_argument("--serve", dest="serve", action="store", metavar="ADDRESS",
+                      help="Read the files once and draw maps on request over HTTP, on ADDRESS, either HOST:PORT or the path of a Unix socket.  The query string of each request gives options for the map the same way as a --views entry")
+  parser.add_argument("--reload", dest="reload", action="store", type=float, default=10, metavar="SECONDS",
+                      help="With --serve, how often to check the input directory for new, changed and removed files.  0 to never check.  Default: 10")
+  parser.add_argument("--views", dest="views", action="store", metavar="FILE",
+                      help="Draw a page for each view listed in FILE, a JSON list of objects or a CSV file with a header row, reading the tracks only once")
+  parser.add_argument("--since", dest="since", action="store", metavar="DATE",
+                      help="Only draw tracks that start on or after DATE, given as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS in UTC")
+  parser.add_argument("--until", dest="until", action="store", metavar="DATE",
+                      help="Only draw tracks that start on or before DATE, given like --since")
+  parser.add_argument("--name", dest="name", action="store", metavar="PATTERN",
+                      help="Only draw tracks whose <name> matches PATTERN, which can use the wildcards * and ?.  Not case sensitive")
+  parser.add_argument("--type", dest="type", action="store", metavar="PATTERN",
+                      help="Only draw tracks whose <type> matches PATTERN, like --name")
   parser.add_argument("--fgcolor", dest="fgcolor", action="store", default="#000000",
                       help="Foreground color in #RRGGBB format")
   parser.add_argument("--bgcolor", dest="bgcolor", action="store", default="#FFFFFF",
@@ -45,6 +193,40 @@ def main():
                       help="Width of line stroke.  Default: 0 (smallest possible that printer can do)")
   parser.add_argument("--droppercent", dest="droppercent", action="store", type=int,
                     help="Percentage of points to uniformly drop.  Results in smaller output")
+  parser.add_argument("--simplify", dest="simplify", action="store", metavar="TOLERANCE",
+                      help="Simplify lines, dropping points that are within TOLERANCE of the simplified line.  In points, or a distance on the ground such as 5m or 20ft")
+  parser.add_argument("--fulldetail", dest="fulldetail", action="store_true",
+                      help="Draw every point.  Otherwise points that are too close together to be told apart on the page are left out, using a level of detail kept with the tracks")
+  parser.add_argument("--dedup", dest="dedup", action="store", metavar="TOLERANCE",
+                      help="Leave out lines that are within TOLERANCE of lines already drawn, such as the same ride recorded by two devices or a commute repeated many times.  In points, or a distance on the ground such as 5m or 20ft.  Can't be used with --raster")
+  parser.add_argument("--raster", dest="raster", action="store", type=int, metavar="DPI",
+                      help="Draw a density map with DPI dots per inch instead of lines, shaded from --bgcolor where there are no tracks to --fgcolor where there are the most.  The output is the same size however many tracks there are")
+  parser.add_argument("--ramp", dest="ramp", action="store", choices=("log", "linear"), default="log",
+                      help="How --raster shades the number of tracks through each dot.  Default: log")
+  parser.add_argument("--clip", dest="clip", action="store_true",
+                      help="Cut lines off at the edge of the map, instead of drawing them to the first point outside of it.  Also draws lines that cross the map without a point on it")
+  parser.add_argument("--compact", dest="compact", action="store_true",
+                      help="Write smaller postscript using short procedure names, relative coordinates and --precision decimal places")
+  parser.add_argument("--precision", dest="precision", action="store", type=int, default=2,
+                      help="Number of decimal places for coordinates in --compact mode.  Default: 2")
+  parser.add_argument("--jobs", dest="jobs", action="store", type=int, default=1,
+                      help="Number of processes to use for reading and drawing files.  Default: 1")
+  parser.add_argument("--cachedir", dest="cachedir", action="store",
+                      help="Directory in which to cache parsed tracks between runs")
+  parser.add_argument("--cachesize", dest="cachesize", action="store", type=int, default=1024,
+                      help="Maximum size of the --cachedir cache in megabytes.  Least recently used entries are removed first.  Default: 1024")
+  parser.add_argument("--index", dest="index", action="store_true",
+                      help="Keep an index of track extents in the input directory and use it to skip files and segments that are outside the map, and to autofit to unchanged files without reading them")
+  parser.add_argument("--trustbounds", dest="trustbounds", action="store_true",
+                      help="In --autofit mode, take the extent of a file with a <bounds> element from it instead of reading the file's points")
+  parser.add_argument("--stats", dest="stats", action="store_true",
+                      help="Print timings for each stage of the run and counts of files, points and bytes to standard error")
+  parser.add_argument("--statsjson", dest="statsjson", action="store", metavar="FILE",
+                      help="Write the --stats timings and counts, including counts for each file, to FILE as JSON")
+  parser.add_argument("--profile", dest="profile", action="store", metavar="FILE",
+                      help="Write cProfile data for the run to FILE, for use with pstats.  With --jobs only the main process is profiled")
+  parser.add_argument("--storelimit", dest="storelimit", action="store", type=int, default=256,
+                      help="Megabytes of parsed points to hold in memory with --autofit or --views before spilling to a temporary file.  Default: 256")
 
   boxgroup.add_argument("--autofit", dest="autofit", action="store_true",
                       help="Automatically crop output to fit data")
@@ -56,6 +238,8 @@ def main():
   boxgroup.add_argument("--tiles", dest="tiles", action="store_true",
                       help="Render in tile mode, with one track per tile")
 
+  parser.add_argument("--tilesperpage", dest="tilesperpage", action="store", type=int, metavar="N",
+                      help="In --tiles mode, put at most N tiles on a page, starting a new page when one is full.  Default: all of them on one page")
   parser.add_argument("--radius", dest="radius", action="store",
                       help="Radius of area to include in output.  Use with --center")
   parser.add_argument("--title", dest="title", action="store",
@@ -74,294 +258,692 @@ def main():
   pagegroup.add_argument("--portrait", dest="orientation",
                          action="store_const", const="portrait",
                          default="landscape", help="Print in portrait mode")
-  args = parser.parse_args()
+  return parser
 
-  if args.replicate != None:
-    foundargs = False
-    try:
-      infile = open(args.replicate)
-    except IOError as detail:
-      sys.stderr.write("Error: " + str(detail) + "\n")
-      sys.exit(1)
-    for line in infile:
-      if line.startswith("% argumentlist "):
-        foundargs = True
-        break
-    infile.close()
 
-    if not foundargs:
-        sys.stderr.write("Error: no argument line found\n")
-        exit(1)
+##
+## run()
+## Everything main() does once the arguments are sorted out
+##
+def run(parser, args, commandline):
+  if args.incremental != None:
+    previous = PreviousOutput(args.incremental)
+    args = replicateargs(parser, previous.arguments, args)
+    if args.tiles == True or args.views != None or args.raster != None or args.dedup != None:
+      raise Gpx2psError("--incremental can't be used with --tiles, --views, --raster or --dedup")
+    if args.format == "pdf" or previous.arguments.get("format") == "pdf":
+      raise Gpx2psError("--incremental only works with postscript")
+  else:
+    previous = None
 
-    argumentlist = line[15:]
-    arguments = json.loads(argumentlist)
+  if args.jobs < 1:
+    raise Gpx2psError("--jobs must be at least 1")
+  if args.serve != None and (args.views != None or args.incremental != None):
+    raise Gpx2psError("--serve can't be used with --views or --incremental")
 
-    newargv = []
-    for key in arguments:
-      if arguments[key] is True:
-        newargv.append("--" + key)
-      if arguments[key] is False:
-        continue
-      if arguments[key] is None:
-        continue
-      if key == "orientation":  # Hacky: "--landscape" and "--portait" end up in the "orientation" variable
-        newargv.append("--" + arguments[key])
+  inputfiles = findfiles(args.inputdir, args.recursive)
+
+  if len(inputfiles) == 0:
+    raise Gpx2psError("no files found")
+
+  if args.index == True:
+    indexdir = args.inputdir
+  else:
+    indexdir = None
+
+  renderer = Renderer(inputfiles, jobs=args.jobs, cachedir=args.cachedir, cachesize=args.cachesize,
+                      indexdir=indexdir, storelimit=args.storelimit, trackfilter=makefilter(args))
+  try:
+    if args.serve != None:
+      renderer.load()
+      serve(renderer, args, commandline)
+    elif args.views != None:
+      views = [parseview(args, entry) for entry in readviews(args.views)]
+      renderer.renderviews(views, args, commandline)
+    else:
+      # Work out the view first, so that a bad setting doesn't leave an empty output file
+      view = renderer.makeview(args, previous)
+      if previous is not None and previous.isfile(args.output):
+        # The previous output is still being read while the new one is written
+        handle, outputname = tempfile.mkstemp(prefix=".gpx2ps", dir=os.path.dirname(os.path.abspath(args.output)))
+        os.close(handle)
       else:
-        newargv.append("--" + key)
-        newargv.append(str(arguments[key]))
-    args = parser.parse_args(newargv)
+        outputname = args.output
+      outfile = openoutput(outputname, args.format)
+      renderer.render(outfile, args, commandline, view, previous)
+      outfile.close()
+      if previous is not None:
+        previous.close()
+      if outputname != args.output:
+        os.rename(outputname, args.output)
+  finally:
+    renderer.close()
 
-  fgrgb = rgbhextofloat(args.fgcolor)
-  bgrgb = rgbhextofloat(args.bgcolor)
-  projfunc = millercylindrical  # FIXME: this should come from the command line
 
-  xtiles = 1
-  ytiles = 1
+##
+## Gpx2psError
+## Raised for bad settings and for output that can't be written.  main()
+## prints the message and exits
+##
+class Gpx2psError(Exception):
+  pass
 
-  if args.orientation == "portrait":
-    papersize = (792, 612)
-  else:
-    papersize = (612, 792)
 
-  if args.droppercent != None:
-    if args.droppercent > 100 or args.droppercent < 0:
-      sys.stderr.write("Error: invalid percent to drop\n")
-      sys.exit(1)
-    keeppercent = 100 - args.droppercent
-  else:
-    keeppercent = 100
+##
+## options()
+## The settings for a map, as a namespace like the one the command line
+## parser produces.  Anything not given gets the same default as on the
+## command line, so options(autofit=True, title="Seattle") is the same as
+## running with --autofit --title Seattle
+##
+def options(**settings):
+  args = makeparser().parse_args([])
+  for key, value in settings.items():
+    if not hasattr(args, key):
+      raise Gpx2psError("unknown option '%s'" % key)
+    setattr(args, key, value)
+  return args
 
-  margin = 0
 
-  inputfiles = glob.glob(args.inputdir + "/*.gpx")
-  inputfiles = sortedanum(inputfiles)
+##
+## findfiles()
+## The gpx files in a directory, in the order they are drawn.  As well as
+## plain .gpx files these are .gpx.gz and .gpx.bz2 files, and the gpx files
+## inside .zip archives, which are named as if the archive were a directory
+## (export.zip/2019/ride.gpx).  With recursive, subdirectories are searched
+## too.  Names starting with a dot are skipped, as the shell would
+##
+INPUTSUFFIXES = (".gpx", ".gpx.gz", ".gpx.bz2")
 
-  if len(inputfiles) == 0:
-    sys.stderr.write("Error: no files found\n")
-    sys.exit(1)
+def findfiles(inputdir, recursive=False):
+  return sortedanum(listfiles(inputdir, recursive))
 
-  #
-  # Bounding box mode:
-  # Use the bounding box provided on the command line to calculate the center point
-  #
-  if args.bbox == None:
-    minlat = -90
-    minlon = -180
-    maxlat = 90
-    maxlon = 180
-    centerlat = 0
-    centerlon = 0
+def listfiles(inputdir, recursive):
+  try:
+    names = os.listdir(inputdir)
+  except OSError:
+    return []
+  inputfiles = []
+  for name in names:
+    if name.startswith("."):
+      continue
+    path = inputdir + "/" + name
+    if name.endswith(INPUTSUFFIXES):
+      inputfiles.append(path)
+    elif name.endswith(".zip") and os.path.isfile(path):
+      inputfiles.extend(archivemembers(path))
+    elif recursive and os.path.isdir(path) and not os.path.islink(path):
+      inputfiles.extend(listfiles(path, recursive))
+  return inputfiles
+
+def archivemembers(archive):
+  try:
+    with zipfile.ZipFile(archive) as infile:
+      names = infile.namelist()
+  except (zipfile.BadZipFile, IOError, OSError) as detail:
+    warn("Bad file: %s: %s" % (archive, detail))
+    return []
+  return [archive + "/" + name for name in names
+          if name.endswith(INPUTSUFFIXES) and not name.rsplit("/", 1)[-1].startswith(".")]
+
+
+##
+## splitmember()
+## For a file inside a zip archive, as findfiles() names them, the
+## (archive, member) pair.  Anything else is (inputfile, None)
+##
+def splitmember(inputfile):
+  i = inputfile.find(".zip/")
+  while i >= 0:
+    if os.path.isfile(inputfile[:i + 4]):
+      return (inputfile[:i + 4], inputfile[i + 5:])
+    i = inputfile.find(".zip/", i + 1)
+  return (inputfile, None)
+
+
+##
+## inputstat()
+## os.stat() of an input file, or of the archive it is in.  Every file in
+## an archive counts as changed when the archive does
+##
+def inputstat(inputfile):
+  return os.stat(splitmember(inputfile)[0])
+
+
+##
+## openinput()
+## Open an input file for reading in binary mode.  Plain .gpx files are
+## opened as they are.  Compressed files and the files in archives are
+## decompressed by a StreamReader as they are read, so no expanded copy is
+## ever written out.  Raises DecompressError if an archive can't be read
+##
+class DecompressError(Exception):
+  pass
+
+def openinput(inputfile):
+  archive, member = splitmember(inputfile)
+  if member is None:
+    rawfile = open(inputfile, "rb")
   else:
-    bbox = args.bbox.split(",")
-    if len(bbox) != 4:
-      sys.stderr.write("Error: not enough items in bounding box list\n")
-      sys.exit(1)
-    minlat = float(bbox[0])
-    minlon = float(bbox[1])
-    maxlat = float(bbox[2])
-    maxlon = float(bbox[3])
-    centerlat = minlat + (maxlat - minlat)/2.0
-    centerlon = minlon + (maxlon - minlon)/2.0
+    try:
+      rawfile = openarchive(archive).open(member)
+    except (zipfile.BadZipFile, KeyError, RuntimeError, NotImplementedError) as detail:
+      raise DecompressError(str(detail))
+  if inputfile.endswith(".gz"):
+    return StreamReader(gzip.GzipFile(fileobj=rawfile), rawfile)
+  if inputfile.endswith(".bz2"):
+    return StreamReader(bz2.BZ2File(rawfile), rawfile)
+  if member is not None:
+    return StreamReader(rawfile, rawfile)
+  return rawfile
 
-  #
-  # Center mode:
-  # Use the center and radius provided on the command line to calculate the bounds
-  #
-  if args.center != None:
-    if args.radius != None:
-      radius = radiustokm(args.radius)
+
+##
+## openarchive()
+## An open ZipFile for an archive.  The last one opened is kept, since the
+## files of an archive are read one after another, and is opened again if
+## the archive changes or this is a new worker process
+##
+OPENARCHIVE = {}    # archive -> (pid, filestamp(), ZipFile)
+
+def openarchive(archive):
+  stamp = filestamp(archive)
+  if archive in OPENARCHIVE and OPENARCHIVE[archive][:2] == (os.getpid(), stamp):
+    return OPENARCHIVE[archive][2]
+  for pid, oldstamp, oldarchive in OPENARCHIVE.values():
+    if pid == os.getpid():
+      oldarchive.close()
+  OPENARCHIVE.clear()
+  infile = zipfile.ZipFile(archive)
+  OPENARCHIVE[archive] = (os.getpid(), stamp, infile)
+  return infile
+
+
+##
+## StreamReader
+## A file object that reads a decompressing stream ahead of its reader, on
+## one of the STREAMTHREADS threads of a shared pool, while the caller
+## parses what has already been decompressed.  Up to STREAMAHEAD chunks of
+## STREAMCHUNK bytes are held at once.  zlib and bz2 let go of the
+## interpreter lock while they work, so decompression and parsing overlap.
+## Data that can't be decompressed raises DecompressError from read().
+## close() (or leaving a with block) must always be called, as it is what
+## stops the thread
+##
+STREAMTHREADS = 4
+STREAMAHEAD = 4
+STREAMCHUNK = 256 * 1024
+STREAMPOOL = []
+
+class StreamReader(object):
+  def __init__(self, stream, rawfile):
+    self.stream = stream
+    self.rawfile = rawfile
+    self.queue = queue.Queue(STREAMAHEAD)
+    self.chunk = b""
+    self.offset = 0
+    self.finished = False   # whether the end of the stream has been read
+    self.closed = False
+    if len(STREAMPOOL) == 0 or STREAMPOOL[0][0] != os.getpid():
+      STREAMPOOL[:] = [(os.getpid(), concurrent.futures.ThreadPoolExecutor(STREAMTHREADS))]
+    STREAMPOOL[0][1].submit(self.fill)
+
+  def fill(self):
+    # Runs on the pool: decompress until the end of the stream or until
+    # close() is called.  The last thing queued is always None
+    try:
+      while not self.closed:
+        chunk = self.stream.read(STREAMCHUNK)
+        if len(chunk) == 0:
+          break
+        self.queue.put(chunk)
+    except (IOError, OSError, EOFError, zlib.error, zipfile.BadZipFile) as detail:
+      self.queue.put(DecompressError(str(detail) or "unexpected end of data"))
+    finally:
+      self.queue.put(None)
+
+  def read(self, size=-1):
+    if size < 0:
+      chunks = [self.chunk[self.offset:]]
+      while self.nextchunk():
+        chunks.append(self.chunk)
+      self.offset = len(self.chunk)
+      return b"".join(chunks)
+    if self.offset >= len(self.chunk) and not self.nextchunk():
+      return b""
+    data = self.chunk[self.offset:self.offset + size]
+    self.offset += len(data)
+    return data
+
+  def nextchunk(self):
+    # Wait for the next chunk, returning False at the end of the stream
+    if self.finished:
+      return False
+    chunk = self.queue.get()
+    if chunk is None or isinstance(chunk, DecompressError):
+      self.finished = True
+      if chunk is not None:
+        self.queue.get()
+        raise chunk
+      return False
+    self.chunk = chunk
+    self.offset = 0
+    return True
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    while not self.finished:
+      if self.queue.get() is None:
+        self.finished = True
+    self.stream.close()
+    self.rawfile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+##
+## EMPTYFILE
+## The (packed, extents) of a file without any tracks
+##
+EMPTYFILE = (([], array.array('d')), [])
+
+
+##
+## Renderer
+## Draws maps of a set of gpx files.  Once load() has been called the
+## parsed tracks are kept in memory (spilling to a temporary file past
+## storelimit megabytes), so a long running program can draw any number of
+## maps without reading the files again; until then files are read as they
+## are drawn.  Autofitting only parses the files whose bounds it can't get
+## from the index (or their <bounds> elements, with trustbounds), and keeps
+## those for drawing.  jobs, cachedir, cachesize and indexdir work like
+## --jobs, --cachedir, --cachesize and --index.  Given a TrackFilter, only
+## the tracks it lets through are read, and with an index, files without any
+## of them aren't read at all
+##
+## renderer = Renderer(findfiles("/tmp/gps"))
+## renderer.load()
+## with open("seattle.ps", "w") as outfile:
+##   renderer.render(outfile, options(center="47.604815,-122.287016", radius="13mi"))
+## renderer.close()
+##
+class Renderer(object):
+  def __init__(self, inputfiles, jobs=1, cachedir=None, cachesize=1024, indexdir=None, storelimit=256,
+               trackfilter=None):
+    self.inputfiles = inputfiles
+    self.storelimit = storelimit
+    self.trackfilter = trackfilter
+    self.store = None
+    self.complete = False   # whether every file has been through the store
+    self.failed = set()     # files that couldn't be parsed into the store
+    self.fitbounds = {}     # trustbounds -> the bounds autofitbounds() found
+    self.ntracks = None     # see counttracks()
+    self.stamps = {}        # inputfile -> filestamp() from just before it was read
+
+    if cachedir != None:
+      self.cache = TrackCache(cachedir, cachesize * 1024 * 1024)
     else:
-      sys.stderr.write("Error: --center requires --radius\n")
-      sys.exit(1)
-    centerlat, centerlon = map(float, args.center.split(","))
-    maxlat, maxlon = radiuspoint(centerlat, centerlon, math.sqrt(2*(radius**2)), 45)
-    minlat, minlon = radiuspoint(centerlat, centerlon, math.sqrt(2*(radius**2)), 225)
+      self.cache = None
 
+    if indexdir != None:
+      self.index = TrackIndex(indexdir)
+    else:
+      self.index = None
 
-  #
-  # Autofit mode:
-  # Run through the files to find the bounds, then calculate the center point
-  #
-  if args.autofit == True:
-    minlat = 500
-    minlon = 500
-    maxlat = -500
-    maxlon = -500
+    if jobs > 1:
+      self.pool = multiprocessing.Pool(jobs)
+    else:
+      self.pool = None
+
+  def load(self):
+    # Parse every file into the point store, if that hasn't been done yet
+    if not self.complete:
+      self.parse([inputfile for inputfile in self.inputfiles if not self.parsed(inputfile)])
+    return self.store
+
+  def indexed(self, inputfile):
+    # What the index knows about a file, as (extents, wanted).  With a track
+    # filter, the extents only cover the tracks it lets through, and wanted
+    # is False if it is known that there aren't any
+    extents = indexextents(self.index, inputfile)
+    if self.trackfilter is None:
+      return (extents, True)
+    tracks = self.index.lookuptracks(inputfile) if self.index is not None else None
+    if tracks is None:
+      return (None, True)
+    wanted = [self.trackfilter.matches(track) for track in tracks]
+    if extents is not None and len(extents) == len(tracks):
+      extents = [trackextents for trackextents, kept in zip(extents, wanted) if kept]
+    else:
+      extents = None
+    if not any(wanted):
+      # Nothing to read, but the file still gets its place in the output
+      return (EMPTYFILE[1], False)
+    return (extents, True)
+
+  def parse(self, inputfiles):
+    # Add these files to the point store, remembering the ones that are bad
+    if self.store is None:
+      self.store = PointStore(self.storelimit * 1024 * 1024)
     for inputfile in inputfiles:
-      try:
-        tree = elementtree.parse(inputfile)
-      except elementtree.ParseError as detail:
-        warn("Bad file: %s: %s" % (inputfile, detail))
+      self.stamps[inputfile] = filestamp(inputfile)
+    self.failed.update(inputfiles)
+    for inputfile, packed in readfiles(inputfiles, self.pool, self.cache, self.trackfilter, self.index):
+      self.store.add(inputfile, packed)
+      self.failed.discard(inputfile)
+    self.complete = all(self.parsed(inputfile) for inputfile in self.inputfiles)
+
+  def refresh(self, inputfiles):
+    # Catch up with a new list of files.  Files that have gone away, or have
+    # changed since they were read, are forgotten, and if everything had
+    # been loaded, the new and changed files are read.  Returns how many
+    # files were added, changed or removed
+    current = set(inputfiles)
+    previous = set(self.inputfiles)
+    stale = [inputfile for inputfile in self.inputfiles if inputfile not in current]
+    stale += [inputfile for inputfile in inputfiles
+              if inputfile in self.stamps and self.stamps[inputfile] != filestamp(inputfile)]
+    added = [inputfile for inputfile in inputfiles if inputfile not in previous]
+    if len(stale) == 0 and len(added) == 0:
+      return 0
+
+    loaded = self.complete
+    for inputfile in stale:
+      self.stamps.pop(inputfile, None)
+      self.failed.discard(inputfile)
+      if self.store is not None:
+        self.store.remove(inputfile)
+    self.inputfiles = inputfiles
+    self.complete = False
+    self.fitbounds = {}
+    self.ntracks = None
+    if loaded:
+      self.load()
+    if self.index is not None:
+      self.index.save(inputfiles)
+    return len(stale) + len(added)
+
+  def parsed(self, inputfile):
+    return inputfile in self.failed or (self.store is not None and inputfile in self.store)
+
+  def autofitbounds(self, trustbounds=False):
+    # The bounds of every track.  Extents are taken from the point store or
+    # the index where they are known, then from the files' <bounds> elements
+    # if they are trusted, and only the files left over are parsed
+    if self.complete:
+      return self.store.bounds
+    if trustbounds in self.fitbounds:
+      return self.fitbounds[trustbounds]
+    bounds = None
+    unknown = []
+    for inputfile in self.inputfiles:
+      if self.parsed(inputfile):
         continue
+      extents, wanted = self.indexed(inputfile)
+      if extents is None and trustbounds and self.trackfilter is None:
+        declared = readdeclaredbounds(inputfile)
+        if declared is not None:
+          extents = [[declared]]
+      if extents is not None:
+        bounds = unionbounds(bounds, extents)
+      else:
+        unknown.append(inputfile)
+    self.parse(unknown)
+    bounds = unionbounds(bounds, [[self.store.bounds]])
+    self.fitbounds[trustbounds] = bounds
+    return bounds
 
-      gpx = doelement(tree.getroot())
-
-      # Find minimum and maximum latitude and longitude
-      for track in gpx:
-        for segment in track:
-          for point in segment:
-            if point[0] > maxlat:
-              maxlat = point[0]
-            if point[0] < minlat:
-              minlat = point[0]
-            if point[1] > maxlon:
-              maxlon = point[1]
-            if point[1] < minlon:
-              minlon = point[1]
-    centerlat = minlat + (maxlat - minlat)/2.0
-    centerlon = minlon + (maxlon - minlon)/2.0
+  def counttracks(self):
+    # How many tracks there are, for laying out tiles.  Taken from the point
+    # store or the index where possible, and otherwise by looking for the end
+    # of each track in the file without parsing it.  Only parsing a file
+    # says how many of its tracks a track filter lets through, so those
+    # files are parsed into the point store
+    if self.ntracks is None:
+      self.ntracks = 0
+      unknown = []
+      for inputfile in self.inputfiles:
+        if self.parsed(inputfile):
+          continue
+        extents, wanted = self.indexed(inputfile)
+        if extents is not None:
+          self.ntracks += len(extents)
+        elif self.trackfilter is not None:
+          unknown.append(inputfile)
+        else:
+          self.ntracks += scantracks(inputfile)
+      if len(unknown) > 0:
+        self.parse(unknown)
+      if self.store is not None:
+        for inputfile, packed, extents in self.store:
+          self.ntracks += len(extents)
+    return self.ntracks
 
-  #
-  # Tiles mode
-  # Set things up for drawing a page full of tiles instead of a single map
-  #
-  if args.tiles == True:
-    margin = 2
-    projfunc = equirectangular
-    (xtiles, ytiles) = tile(len(inputfiles), papersize[1], papersize[0])
+  def files(self, detail=0):
+    # (inputfile, packed, extents) for each file that isn't known to be bad,
+    # in order, with packed and extents None where they aren't known yet.
+    # packed is at the given level of detail
+    for inputfile in self.inputfiles:
+      if inputfile in self.failed:
+        continue
+      stored = self.store.get(inputfile, detail) if self.store is not None else None
+      if stored is not None:
+        yield stored
+      else:
+        extents, wanted = self.indexed(inputfile)
+        if not wanted:
+          STATS.count("filteredfiles")
+        yield (inputfile, None if wanted else EMPTYFILE[0], extents)
 
-  #
-  # By this point we should have the bounding box and center point calculated
-  # Now it's time to fix the aspect ratio, expanding in one direction as needed
-  # Takes latitude into account to fix proportions
-  #
-  latdist = haversine(maxlat, centerlon, minlat, centerlon)
-  londist = haversine(centerlat, maxlon, centerlat, minlon)
+  def stream(self):
+    # Like files(), but reading the files that aren't in the point store as
+    # it goes, unless they are known to have nothing in them
+    plan = []   # (inputfile, where its points come from)
+    for inputfile in self.inputfiles:
+      if inputfile in self.failed:
+        continue
+      if self.store is not None and inputfile in self.store:
+        plan.append((inputfile, "store"))
+      elif not self.indexed(inputfile)[1]:
+        plan.append((inputfile, "empty"))
+      else:
+        plan.append((inputfile, "read"))
+    parsed = readfiles([inputfile for inputfile, source in plan if source == "read"],
+                       self.pool, self.cache, self.trackfilter, self.index)
+    pending = None
+    for inputfile, source in plan:
+      if source == "store":
+        yield self.store.get(inputfile)
+        continue
+      if source == "empty":
+        STATS.count("filteredfiles")
+        yield (inputfile,) + EMPTYFILE
+        continue
+      if pending is None:
+        pending = next(parsed, None)
+      if pending is not None and pending[0] == inputfile:
+        yield (inputfile, pending[1], None)
+        pending = None
+      # otherwise the file was bad, and has been warned about
 
-  if londist/latdist < float(papersize[1])/float(papersize[0]):
-    height = latdist
-    newwidth = height * (float(papersize[1])/float(papersize[0]))
-    maxlon = radiuspoint(centerlat, centerlon, newwidth/2.0, 90)[1]
-    minlon = radiuspoint(centerlat, centerlon, newwidth/2.0, 270)[1]
-  else:
-    width = londist
-    newheight = width / (float(papersize[1])/float(papersize[0]))
-    maxlat = radiuspoint(centerlat, centerlon, newheight/2.0, 0)[0]
-    minlat = radiuspoint(centerlat, centerlon, newheight/2.0, 180)[0]
+  def makeview(self, args, previous=None):
+    if previous is not None:
+      # Keep the map where it was, even if new tracks are outside of it
+      if args.autofit == True and previous.databounds is None:
+        raise Gpx2psError("%s doesn't say what it was autofitted to, so it can't be brought up to date" % previous.filename)
+      databounds = previous.databounds
+    # Autofit mode needs the bounds of every track before anything is drawn
+    elif args.autofit == True:
+      databounds = self.autofitbounds(args.trustbounds)
+    elif self.store is not None:
+      databounds = self.store.bounds
+    else:
+      databounds = None
+    if args.tiles == True:
+      ntracks = self.counttracks()
+    else:
+      ntracks = 0
+    return makeview(args, databounds, ntracks)
 
-  # Project the minimum and maximum latitude and longitude values onto a
-  # cartesian grid
-  minx, miny = projfunc(centerlat, centerlon, minlat, minlon)
-  maxx, maxy = projfunc(centerlat, centerlon, maxlat, maxlon)
+  def render(self, outfile, args, commandline="", view=None, previous=None):
+    # Write a complete single page document to outfile, which takes text,
+    # or bytes with --format pdf.  Given a PreviousOutput, the postscript
+    # for files that haven't changed since it was written is copied from it
+    # instead of being drawn again
+    if view is None:
+      view = self.makeview(args, previous)
+    writer = makewriter(outfile, args)
+    writer.header(commandline, args, view)
+    if view.pages > 1:
+      writer.startpage()
+    self.drawpage(writer, args, view, previous)
+    if view.pages > 1:
+      writer.showpage()
+    writer.finish()
 
-  #
-  # Start printing out the postscript
-  #
-  print("%!PS")
-  print("%% Generated with %s" % commandline)
-  print("%% argumentlist %s" % (json.dumps(vars(args))))
-  if args.orientation == "landscape":
-    print("90 rotate")
-    print("%d %d translate" % (0, papersize[0]*-1))
-  print("{} setlinewidth".format(args.linewidth))  # '0' means "thinnest possible on device"
-  print("1 setlinecap")    # rounded
-  print("1 setlinejoin")   # rounded
-  print("%f %f %f setrgbcolor clippath fill" % bgrgb) # set the background fill
-  print("%f %f %f setrgbcolor" % fgrgb)               # set the foreground color
+  def renderviews(self, views, args, commandline=""):
+    # Draw a map for each set of arguments in views.  Those with the same
+    # output as args are drawn as the pages of one document written there,
+    # and the rest as documents of their own.  Every view is worked out
+    # before anything is written, so that a bad setting in one of them
+    # doesn't leave the others half written
+    self.load()
+    views = [(viewargs, self.makeview(viewargs)) for viewargs in views]
+    outfile = None
+    for viewargs, view in views:
+      if viewargs.output != args.output:
+        pagefile = openoutput(viewargs.output, viewargs.format)
+        self.render(pagefile, viewargs, commandline, view)
+        pagefile.close()
+      else:
+        if outfile is None:
+          outfile = openoutput(args.output, args.format)
+          writer = makewriter(outfile, args)
+          writer.header(commandline, args)
+        writer.startpage()
+        self.drawpage(writer, viewargs, view)
+        writer.showpage()
+    if outfile is not None:
+      writer.finish()
+      outfile.close()
 
-  #
-  # Run through all of the files and print out postscript commands when appropriate
-  #
+  def drawpage(self, writer, args, view, previous=None):
+    writer.pagesetup(args, view)
+    if view.raster is not None:
+      # The files are drawn into a density grid, which is written out at the end
+      target = DensityGrid(view)
+    else:
+      target = writer
+    if args.tiles == True:
+      files = self.stream()
 
-  xoffset = 0
-  yoffset = 1 - ytiles
-  for inputfile in inputfiles:
-    try:
-      tree = elementtree.parse(inputfile)
-    except elementtree.ParseError as detail:
-      warn("Bad file: %s: %s" % (inputfile, detail))
-      continue
+      def nextpage(target):
+        # Finish a full page of tiles and set up the next one the same way
+        if view.raster is not None:
+          target.emit(writer, args, view)
+          target = DensityGrid(view)
+        writer.title(args, view)
+        writer.showpage()
+        writer.startpage()
+        writer.pagesetup(args, view)
+        return target
 
-    gpx = doelement(tree.getroot())
-
-    print("%% File: %s" % inputfile)
-    for track in gpx:
-
-      if args.tiles is True:
-        # In tiles mode, find the minimum an maximum lon/lat for each track
-        minlat = 500
-        minlon = 500
-        maxlat = -500
-        maxlon = -500
-        for segment in track:
-          for point in segment:
-            if point[0] > maxlat:
-              maxlat = point[0]
-            if point[0] < minlat:
-              minlat = point[0]
-            if point[1] > maxlon:
-              maxlon = point[1]
-            if point[1] < minlon:
-              minlon = point[1]
-        centerlat = minlat + (maxlat - minlat)/2.0
-        centerlon = minlon + (maxlon - minlon)/2.0
-        minx, miny = projfunc(centerlat, centerlon, minlat, minlon)
-        maxx, maxy = projfunc(centerlat, centerlon, maxlat, maxlon)
+      target = drawtiles(target, files, view, nextpage)
+    else:
+      drawfiles(target, self.files(view.detail), view, self.pool, self.cache, self.index, previous, self.trackfilter)
+    if view.raster is not None:
+      target.emit(writer, args, view)
+    writer.title(args, view)
 
-      for segment in track:
-        #print("newpath")
-        prevdrawn = False
-        newpathwritten = False
-        totaldrawn = 0.0
-        totalseen = 0.0
-        for i in range(1, len(segment)):
-          totalseen += 1
-          if totaldrawn / totalseen > keeppercent/100.0:
-            continue
-          totaldrawn += 1
-          x, y = projfunc(centerlat, centerlon, segment[i][0], segment[i][1])
-          # Check to see if this point is in the bounding box
-          if ((segment[i][0] > minlat and segment[i][0] < maxlat) and
-              (segment[i][1] > minlon and segment[i][1] < maxlon)):
-            # We're in the bounding box.  If the previous point was not drawn, we need
-            # to moveto it.
-            if prevdrawn == False:
-              if newpathwritten == False:
-                # This is the start of a new path
-                print("newpath")
-                newpathwritten = True
-              px, py = projfunc(centerlat, centerlon, segment[i-1][0], segment[i-1][1])
-              print("%f %f moveto" % (scale(px,
-                                            (minx, maxx),
-                                            (0 + margin, papersize[1]/xtiles - margin)) + xoffset*(papersize[1]/xtiles),
-                                      scale(py,
-                                            (miny ,maxy),
-                                            (0 + margin, papersize[0]/ytiles - margin)) - yoffset*(papersize[0]/ytiles)
-                                           ))
-            # Always draw the current point since it is in the bounding box (see above)
-            print("%f %f lineto" % (scale(x,
-                                          (minx, maxx),
-                                          (0 + margin, papersize[1]/xtiles - margin)) + xoffset*(papersize[1]/xtiles),
-                                    scale(y,
-                                          (miny, maxy),
-                                          (0 + margin, papersize[0]/ytiles - margin)) - yoffset*(papersize[0]/ytiles)
-                                         ))
-            prevdrawn = True
-          else:
-            # We're not in the bounding box.  But if the previous point was drawn, we
-            # need a line out to this point
-            if prevdrawn == True:
-              print("%f %f lineto" % (scale(x,
-                                            (minx, maxx),
-                                            (0 + margin, papersize[1]/xtiles - margin)) + xoffset*(papersize[1]/xtiles),
-                                      scale(y,
-                                            (miny, maxy),
-                                            (0 + margin, papersize[0]/ytiles - margin)) - yoffset*(papersize[0]/ytiles)
-                                           ))
-            prevdrawn = False
-        if newpathwritten == True:
-          # If we started a newpath, we need to stroke it here
-          print("stroke")
-
-      if args.tiles is True:
-        xoffset += 1
-        if xoffset >= xtiles:
-          xoffset = 0
-          yoffset += 1
-
-  if args.title != None:
-    print("% Title stuff")
-    print("""/thinfont /%s def
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    if self.cache is not None:
+      self.cache.trim()
+    if self.index is not None:
+      self.index.save(self.inputfiles)
+    if self.store is not None:
+      self.store.close()
+      self.store = None
+
+
+##
+## PostScriptWriter
+## Writes postscript to any file-like object that takes text
+##
+class PostScriptWriter(object):
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self.pages = 0
+
+  def header(self, commandline, args, view=None):
+    self.writeline("%!PS")
+    self.writeline("%% Generated with %s" % commandline)
+    self.writeline("%% argumentlist %s" % (json.dumps(vars(args))))
+    if view is not None and view.databounds is not None:
+      # Needed to draw the same map again with --incremental
+      self.writeline("%% autofitbounds %s" % (json.dumps(view.databounds)))
+
+  def startpage(self):
+    # Only needed for documents with more than one page
+    self.pages += 1
+    self.writeline("%%%%Page: %d %d" % (self.pages, self.pages))
+
+  def showpage(self):
+    self.writeline("showpage")
+
+  def pagesetup(self, args, view):
+    papersize = view.papersize
+    fgrgb = view.fgrgb
+    bgrgb = view.bgrgb
+    if args.orientation == "landscape":
+      self.writeline("90 rotate")
+      self.writeline("%d %d translate" % (0, papersize[0]*-1))
+    self.writeline("{} setlinewidth".format(args.linewidth))  # '0' means "thinnest possible on device"
+    self.writeline("1 setlinecap")    # rounded
+    self.writeline("1 setlinejoin")   # rounded
+    self.writeline("%f %f %f setrgbcolor clippath fill" % bgrgb) # set the background fill
+    self.writeline("%f %f %f setrgbcolor" % fgrgb)               # set the foreground color
+    if args.compact == True:
+      self.write(COMPACTPROLOG)
+
+  def write(self, text):
+    writeoutput(self.outfile, text)
+
+  def writeline(self, text):
+    writeoutput(self.outfile, text + "\n")
+
+  def image(self, width, height, data, papersize):
+    # An RGB image covering the page, given as rows of pixels from the top
+    with STATS.stage("raster"):
+      encoded = base64.a85encode(zlib.compress(data, 9), wrapcol=76)
+    self.write("gsave\n")
+    self.write("%d %d scale\n" % (papersize[1], papersize[0]))
+    self.write("%d %d 8 [%d 0 0 -%d 0 %d]\n" % (width, height, width, height, height))
+    self.write("currentfile /ASCII85Decode filter /FlateDecode filter\n")
+    self.write("false 3 colorimage\n")
+    self.write(encoded.decode("ascii"))
+    self.write("~>\ngrestore\n")
+
+  def finish(self):
+    pass
+
+  def title(self, args, view):
+    if args.title == None:
+      return
+
+    fgrgb = view.fgrgb
+    bgrgb = view.bgrgb
+    self.writeline("% Title stuff")
+    self.writeline("""/thinfont /%s def
 /boldfont /%s def
 /fontsize %d def
 /shadowstroke fontsize 3 div def
@@ -432,83 +1014,3122 @@ def main():
       thintitlestring = result.group(1)
       boldtitlestring = result.group(2)
 
-      print("%f %f %f setrgbcolor" % (bgrgb))
-      print("(%s) (%s) rjmoveto" % (boldtitlestring, thintitlestring))
-      print("(%s) showshadowthin" % (thintitlestring))
-      print("(%s) () rjmoveto" % (boldtitlestring))
-      print("(%s) showshadowbold" % (boldtitlestring))
-      print("%f %f %f setrgbcolor" % (fgrgb))
-      print("(%s) (%s) rjmoveto" % (boldtitlestring, thintitlestring))
-      print("(%s) showthin" % (thintitlestring))
-      print("(%s) showbold" % (boldtitlestring))
+      self.writeline("%f %f %f setrgbcolor" % (bgrgb))
+      self.writeline("(%s) (%s) rjmoveto" % (boldtitlestring, thintitlestring))
+      self.writeline("(%s) showshadowthin" % (thintitlestring))
+      self.writeline("(%s) () rjmoveto" % (boldtitlestring))
+      self.writeline("(%s) showshadowbold" % (boldtitlestring))
+      self.writeline("%f %f %f setrgbcolor" % (fgrgb))
+      self.writeline("(%s) (%s) rjmoveto" % (boldtitlestring, thintitlestring))
+      self.writeline("(%s) showthin" % (thintitlestring))
+      self.writeline("(%s) showbold" % (boldtitlestring))
     else:
       # Assume it is just thin  FIXME: should probably allow for just bold too
-      print("%f %f %f setrgbcolor" % (bgrgb))
-      print("(%s) rjmovetothinonly" % (args.title))
-      print("(%s) showshadowthin" % (args.title))
-      print("%f %f %f setrgbcolor" % (fgrgb))
-      print("(%s) rjmovetothinonly" % (args.title))
-      print("(%s) showthin" % (args.title))
+      self.writeline("%f %f %f setrgbcolor" % (bgrgb))
+      self.writeline("(%s) rjmovetothinonly" % (args.title))
+      self.writeline("(%s) showshadowthin" % (args.title))
+      self.writeline("%f %f %f setrgbcolor" % (fgrgb))
+      self.writeline("(%s) rjmovetothinonly" % (args.title))
+      self.writeline("(%s) showthin" % (args.title))
+
 
 
 ##
-## doelement()
+## PdfWriter
+## Writes PDF to any file-like object that takes bytes, taking the same
+## calls as PostScriptWriter.  What is written is compressed into a Flate
+## content stream as it comes, and each stream's length is an object of its
+## own written after it, so nothing is held back and the output doesn't
+## have to be seekable.  The objects that are only complete at the end, the
+## fonts, the page tree and the catalog, can be referred to before then and
+## are written by finish().  A page's contents can be several streams, so
+## that the image of a --raster map can be written as an object of its own
+## part way through the page.  Content streams are compressed at zlib level
+## PDFCOMPRESSION: on a large map, level 6 only takes another tenth off the
+## size, at five times the cost
 ##
-def doelement(element):
+PDFCOMPRESSION = 1
 
-  if element.tag.endswith("gpx"):
-    gpx = []
-    for child in element:
-      if child.tag.endswith("trk"):
-        gpx.append(doelement(child))
-    return gpx
+class PdfWriter(object):
+  CATALOG = 1
+  PAGES = 2
 
-  if element.tag.endswith("trk"):
-    track = []
-    for child in element:
-      if child.tag.endswith("trkseg"):
-        track.append(doelement(child))
-    return track
-
-  if element.tag.endswith("trkseg"):
-    segment = []
-    for child in element:
-      segment.append(doelement(child))
-    return segment
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self.offset = 0
+    self.offsets = {}     # object number -> where it starts in the file
+    self.nobjects = 2
+    self.fonts = {}       # font name -> object number
+    self.pageids = []
+    self.page = None      # the page being written: {size, contents, resources}
+    self.stream = None    # (length object, where the data starts, compressor) of the content stream being written
 
-  if element.tag.endswith("trkpt"):
-    lat = float(element.attrib['lat'])
-    lon = float(element.attrib['lon'])
-    return (lat, lon)
+  def newobject(self):
+    self.nobjects += 1
+    return self.nobjects
 
+  def put(self, data):
+    writeoutput(self.outfile, data)
+    self.offset += len(data)
 
-##
-## warn()
-##
-def warn(message):
-  sys.stderr.write(message + "\n")
+  def startobject(self, number):
+    self.offsets[number] = self.offset
+    self.put(b"%d 0 obj\n" % number)
 
+  def header(self, commandline, args, view=None):
+    encoding = locale.getpreferredencoding(False)
+    self.put(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    self.put(("%% Generated with %s\n" % commandline).encode(encoding, "replace"))
+    self.put(("%% argumentlist %s\n" % json.dumps(vars(args))).encode(encoding, "replace"))
+    if view is not None and view.databounds is not None:
+      self.put(("%% autofitbounds %s\n" % json.dumps(view.databounds)).encode(encoding))
 
-##
-## scale()
-## Scales a value from tuple src to tuple dst
-##
-def scale(val, src, dst):
-  return ((float(val) - float(src[0])) / (float(src[1])-float(src[0]))) * (float(dst[1])-float(dst[0])) + float(dst[0])
+  def startpage(self):
+    pass    # pages start with pagesetup()
 
-##
-## equirectangular()
-## Performs the equirectangular projection calculation
-##
-def equirectangular(centlat, centlon, lat, lon):
-  return (lon, lat)
+  def pagesetup(self, args, view):
+    papersize = view.papersize
+    self.page = {"size": papersize, "contents": [], "fonts": {}, "images": {}}
+    self.startstream()
+    fgrgb = view.fgrgb
+    bgrgb = view.bgrgb
+    self.write("{} w\n".format(args.linewidth))   # '0' means "thinnest possible on device"
+    self.write("1 J\n")    # rounded
+    self.write("1 j\n")    # rounded
+    self.write("%f %f %f rg 0 0 %d %d re f\n" % (bgrgb + (papersize[1], papersize[0])))
+    self.write("%f %f %f RG %f %f %f rg\n" % (fgrgb + fgrgb))
 
+  def startstream(self):
+    number = self.newobject()
+    length = self.newobject()
+    self.startobject(number)
+    self.put(b"<< /Length %d 0 R /Filter /FlateDecode >>\nstream\n" % length)
+    self.stream = (length, self.offset, zlib.compressobj(PDFCOMPRESSION))
+    self.page["contents"].append(number)
 
-##
-## millercylindrical()
-## Performs the miller cylindrical projection calculation
-##
-def millercylindrical(centlat, centlon, lat, lon):
+  def endstream(self):
+    length, start, compressor = self.stream
+    with STATS.stage("write"):
+      data = compressor.flush()
+    self.put(data)
+    size = self.offset - start
+    self.put(b"\nendstream\nendobj\n")
+    self.startobject(length)
+    self.put(b"%d\nendobj\n" % size)
+    self.stream = None
+
+  def write(self, text):
+    with STATS.stage("write"):
+      data = self.stream[2].compress(text.encode("utf-8"))
+    if len(data) > 0:
+      self.put(data)
+
+  def image(self, width, height, data, papersize):
+    # An RGB image covering the page, given as rows of pixels from the top
+    self.endstream()
+    number = self.newobject()
+    with STATS.stage("raster"):
+      data = zlib.compress(data, 9)
+    self.startobject(number)
+    self.put(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB "
+             b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n" % (width, height, len(data)))
+    self.put(data)
+    self.put(b"\nendstream\nendobj\n")
+    self.page["images"]["Im%d" % number] = number
+    self.startstream()
+    self.write("q %d 0 0 %d 0 0 cm /Im%d Do Q\n" % (papersize[1], papersize[0], number))
+
+  def font(self, name):
+    # The resource name of a font, which is written out by finish()
+    if name not in self.fonts:
+      self.fonts[name] = self.newobject()
+    self.page["fonts"]["F%d" % self.fonts[name]] = self.fonts[name]
+    return "F%d" % self.fonts[name]
+
+  def showpage(self):
+    if self.page is None:
+      return
+    self.endstream()
+    number = self.newobject()
+    size = self.page["size"]
+    resources = [b"/%s %d 0 R" % (name.encode("ascii"), n) for name, n in sorted(self.page["fonts"].items())]
+    images = [b"/%s %d 0 R" % (name.encode("ascii"), n) for name, n in sorted(self.page["images"].items())]
+    self.startobject(number)
+    self.put(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents [%s]\n"
+             b"   /Resources << /Font << %s >> /XObject << %s >> >> >>\nendobj\n" %
+             (self.PAGES, size[1], size[0], b" ".join(b"%d 0 R" % n for n in self.page["contents"]),
+              b" ".join(resources), b" ".join(images)))
+    self.pageids.append(number)
+    self.page = None
+
+  def finish(self):
+    self.showpage()
+    for name, number in sorted(self.fonts.items(), key=lambda font: font[1]):
+      self.startobject(number)
+      self.put(b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>\nendobj\n" %
+               pdfname(name))
+    self.startobject(self.PAGES)
+    self.put(b"<< /Type /Pages /Kids [%s] /Count %d >>\nendobj\n" %
+             (b" ".join(b"%d 0 R" % n for n in self.pageids), len(self.pageids)))
+    self.startobject(self.CATALOG)
+    self.put(b"<< /Type /Catalog /Pages %d 0 R >>\nendobj\n" % self.PAGES)
+    xref = self.offset
+    entries = [b"xref\n0 %d\n0000000000 65535 f \n" % (self.nobjects + 1)]
+    entries += [b"%010d 00000 n \n" % self.offsets[n] for n in range(1, self.nobjects + 1)]
+    self.put(b"".join(entries))
+    self.put(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" %
+             (self.nobjects + 1, self.CATALOG, xref))
+
+  def title(self, args, view):
+    # The same title PostScriptWriter draws: right aligned at the bottom of
+    # the page, thin text and then bold, each outlined in the background
+    # color.  PDF can't measure text, so where it starts is worked out with
+    # the widths of the standard fonts the title is drawn in (see pdffont())
+    if args.title == None:
+      return
+
+    fgrgb = view.fgrgb
+    bgrgb = view.bgrgb
+    result = re.search(r'^(.*?)\[(.*?)\]$', args.title)
+    if result != None:
+      thintitlestring = result.group(1)
+      boldtitlestring = result.group(2)
+    else:
+      thintitlestring = args.title
+      boldtitlestring = ""
+    thinfont, thinwidths = pdffont(args.thinfont, "thinfont")
+    boldfont, boldwidths = pdffont(args.boldfont, "boldfont")
+    x = 772 - textwidth(thintitlestring, thinwidths, args.fontsize)
+    x -= textwidth(boldtitlestring, boldwidths, args.fontsize)
+
+    text = "BT %f 20 Td /%s %d Tf %s Tj" % (x, self.font(thinfont), args.fontsize, pdfstring(thintitlestring))
+    if boldtitlestring != "":
+      text += " /%s %d Tf %s Tj" % (self.font(boldfont), args.fontsize, pdfstring(boldtitlestring))
+    self.write("% Title stuff\nq\n")
+    self.write("%f %f %f RG %f %f %f rg\n" % (bgrgb + bgrgb))
+    self.write("%f w 1 Tr %s ET\n" % (args.fontsize / 3.0, text))   # the outline
+    self.write("%f %f %f RG %f %f %f rg\n" % (fgrgb + fgrgb))
+    self.write("0 Tr %s ET\nQ\n" % text)
+
+
+##
+## makewriter()
+## The PostScriptWriter or PdfWriter for args.format
+##
+def makewriter(outfile, args):
+  if args.format == "pdf":
+    return PdfWriter(outfile)
+  return PostScriptWriter(outfile)
+
+
+##
+## pdfstring() / pdfname()
+## A PDF literal string holding text, in the WinAnsiEncoding the fonts are
+## given, and a font name as a PDF name.  Both are plain ASCII
+##
+def pdfstring(text):
+  parts = []
+  for c in bytearray(text.encode("cp1252", "replace")):
+    if c in b"\\()":
+      parts.append("\\" + chr(c))
+    elif 32 <= c <= 126:
+      parts.append(chr(c))
+    else:
+      parts.append("\\%03o" % c)
+  return "(%s)" % "".join(parts)
+
+def pdfname(name):
+  return "".join(c if 33 <= ord(c) <= 126 and c not in "()<>[]{}/%#" else "#%02X" % ord(c)
+                 for c in name).encode("latin-1", "replace")
+
+
+##
+## textwidth() / pdffont()
+## textwidth() gives the width in points of text in a font with the given
+## widths, in thousandths of the font size for the characters from space to
+## tilde.  Other characters are taken to be as wide as a digit.
+## pdffont() gives the standard font that a --thinfont or --boldfont is
+## drawn with in PDF output, and its widths.  The 14 standard fonts are the
+## only ones a PDF can name without giving their metrics, so a PDF title is
+## limited to those in PDFFONTS.  Helvetica-Light, the default --thinfont,
+## isn't one of them and is drawn as Helvetica.  Raises Gpx2psError for any
+## other font
+##
+HELVETICAWIDTHS = (
+  278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+  556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+  1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+  667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+  333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+  556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584)
+HELVETICABOLDWIDTHS = (
+  278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+  556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+  975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+  667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+  333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+  611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584)
+COURIERWIDTHS = (600,) * 95
+
+PDFFONTS = {
+  "Helvetica": ("Helvetica", HELVETICAWIDTHS),
+  "Helvetica-Light": ("Helvetica", HELVETICAWIDTHS),
+  "Helvetica-Oblique": ("Helvetica-Oblique", HELVETICAWIDTHS),
+  "Helvetica-Bold": ("Helvetica-Bold", HELVETICABOLDWIDTHS),
+  "Helvetica-BoldOblique": ("Helvetica-BoldOblique", HELVETICABOLDWIDTHS),
+  "Courier": ("Courier", COURIERWIDTHS),
+  "Courier-Oblique": ("Courier-Oblique", COURIERWIDTHS),
+  "Courier-Bold": ("Courier-Bold", COURIERWIDTHS),
+  "Courier-BoldOblique": ("Courier-BoldOblique", COURIERWIDTHS),
+}
+
+def textwidth(text, widths, fontsize):
+  total = 0
+  for c in text:
+    if 32 <= ord(c) <= 126:
+      total += widths[ord(c) - 32]
+    else:
+      total += widths[ord("0") - 32]
+  return total * fontsize / 1000.0
+
+def pdffont(name, option):
+  if name not in PDFFONTS:
+    raise Gpx2psError("--%s %s can't be used with --format pdf, only %s" % (option, name, ", ".join(sorted(PDFFONTS))))
+  return PDFFONTS[name]
+
+
+##
+## makeview()
+## Work out the part of the world a page shows from the bbox, center,
+## autofit or tiles options, widened to the shape of the paper.
+## databounds are the (minlat, minlon, maxlat, maxlon) of all of the tracks,
+## used in autofit mode, and ntracks is the number of tracks, used in tiles
+## mode
+##
+def makeview(args, databounds, ntracks):
+  projection = PROJECTIONS["millercylindrical"]  # FIXME: this should come from the command line
+
+  xtiles = 1
+  ytiles = 1
+
+  if args.orientation == "portrait":
+    papersize = (792, 612)
+  else:
+    papersize = (612, 792)
+
+  fgrgb = rgbhextofloat(args.fgcolor)
+  bgrgb = rgbhextofloat(args.bgcolor)
+  if args.format == "pdf" and args.title != None:
+    pdffont(args.thinfont, "thinfont")
+    pdffont(args.boldfont, "boldfont")
+
+  if args.droppercent != None:
+    if args.droppercent > 100 or args.droppercent < 0:
+      raise Gpx2psError("invalid percent to drop")
+    keeppercent = 100 - args.droppercent
+  else:
+    keeppercent = 100
+
+  if args.simplify != None:
+    simplify = parsetolerance(args.simplify)
+  else:
+    simplify = None
+
+  if args.dedup != None:
+    if args.raster != None:
+      raise Gpx2psError("--dedup can't be used with --raster")
+    dedup = parsetolerance(args.dedup, "dedup")
+  else:
+    dedup = None
+
+  if args.precision < 0:
+    raise Gpx2psError("--precision can't be negative")
+  if args.compact == True:
+    precision = args.precision
+  else:
+    precision = None
+
+  if args.raster != None and (args.raster < 1 or args.raster > 1200):
+    raise Gpx2psError("--raster must be between 1 and 1200 dots per inch")
+
+  margin = 0
+
+  #
+  # Bounding box mode:
+  # Use the bounding box provided on the command line to calculate the center point
+  #
+  if args.bbox == None:
+    minlat = -90
+    minlon = -180
+    maxlat = 90
+    maxlon = 180
+    centerlat = 0
+    centerlon = 0
+  else:
+    bbox = args.bbox.split(",")
+    if len(bbox) != 4:
+      raise Gpx2psError("not enough items in bounding box list")
+    try:
+      minlat = float(bbox[0])
+      minlon = float(bbox[1])
+      maxlat = float(bbox[2])
+      maxlon = float(bbox[3])
+    except ValueError:
+      raise Gpx2psError("bounding box '%s' could not be parsed" % args.bbox)
+    centerlat = minlat + (maxlat - minlat)/2.0
+    centerlon = minlon + (maxlon - minlon)/2.0
+
+  #
+  # Center mode:
+  # Use the center and radius provided on the command line to calculate the bounds
+  #
+  if args.center != None:
+    if args.radius != None:
+      radius = radiustokm(args.radius)
+    else:
+      raise Gpx2psError("--center requires --radius")
+    try:
+      centerlat, centerlon = map(float, args.center.split(","))
+    except ValueError:
+      raise Gpx2psError("center '%s' could not be parsed.  Use LAT,LON" % args.center)
+    maxlat, maxlon = radiuspoint(centerlat, centerlon, math.sqrt(2*(radius**2)), 45)
+    minlat, minlon = radiuspoint(centerlat, centerlon, math.sqrt(2*(radius**2)), 225)
+
+  #
+  # Autofit mode:
+  # Use the bounds of the data, then calculate the center point
+  #
+  if args.autofit == True:
+    if databounds is not None:
+      minlat, minlon, maxlat, maxlon = databounds
+    else:
+      minlat, minlon, maxlat, maxlon = (500, 500, -500, -500)
+    centerlat = minlat + (maxlat - minlat)/2.0
+    centerlon = minlon + (maxlon - minlon)/2.0
+
+  #
+  # Tiles mode
+  # Set things up for drawing a page full of tiles instead of a single map
+  #
+  pagetiles = None
+  if args.tiles == True:
+    margin = 2
+    projection = PROJECTIONS["equirectangular"]
+    if args.tilesperpage != None:
+      if args.tilesperpage < 1:
+        raise Gpx2psError("--tilesperpage must be at least 1")
+      pagetiles = min(args.tilesperpage, max(ntracks, 1))
+    else:
+      pagetiles = max(ntracks, 1)
+    (xtiles, ytiles) = tile(pagetiles, papersize[1], papersize[0])
+
+  #
+  # By this point we should have the bounding box and center point calculated
+  # Now it's time to fix the aspect ratio, expanding in one direction as needed
+  # Takes latitude into account to fix proportions
+  #
+  latdist = haversine(maxlat, centerlon, minlat, centerlon)
+  londist = haversine(centerlat, maxlon, centerlat, minlon)
+
+  if londist/latdist < float(papersize[1])/float(papersize[0]):
+    height = latdist
+    newwidth = height * (float(papersize[1])/float(papersize[0]))
+    maxlon = radiuspoint(centerlat, centerlon, newwidth/2.0, 90)[1]
+    minlon = radiuspoint(centerlat, centerlon, newwidth/2.0, 270)[1]
+  else:
+    width = londist
+    newheight = width / (float(papersize[1])/float(papersize[0]))
+    maxlat = radiuspoint(centerlat, centerlon, newheight/2.0, 0)[0]
+    minlat = radiuspoint(centerlat, centerlon, newheight/2.0, 180)[0]
+
+  view = View(projection, centerlat, centerlon, minlat, minlon, maxlat, maxlon,
+              margin, papersize, xtiles, ytiles, keeppercent, precision, simplify, args.clip,
+              args.raster, args.fulldetail, dedup, args.format == "pdf", fgrgb, bgrgb)
+  if args.autofit == True:
+    view.databounds = databounds
+  if pagetiles is not None:
+    view.pagetiles = pagetiles
+    view.pages = max(int(math.ceil(float(ntracks) / pagetiles)), 1)
+  return view
+
+
+##
+## drawfiles()
+## Draw files given as (inputfile, packed, extents) tuples, where packed and
+## extents are None if they aren't known yet.  Extents and tracks found while
+## drawing are recorded in the index if there is one, except for the extents
+## of files read through a TrackFilter, which only cover some of the tracks.
+## Files that haven't changed since the PreviousOutput previous was written
+## are copied from it
+##
+def drawfiles(writer, files, view, pool, cache, index, previous=None, trackfilter=None):
+  if view.coverage is not None:
+    # Whether a line is drawn depends on every file drawn before it
+    pool = None
+  order = collections.deque()   # (inputfile, copied from previous) for files not yet written
+
+  def makejobs():
+    for inputfile, packed, extents in files:
+      if previous is not None and previous.unchanged(inputfile):
+        order.append((inputfile, True))
+        continue
+      order.append((inputfile, False))
+      if packed is not None and extents is not None and not fileoverlaps(extents, view):
+        packed = None   # drawfile() skips it without needing the points
+      yield (inputfile, packed, view, cache, extents, trackfilter)
+
+  def writecopied():
+    while len(order) > 0 and order[0][1]:
+      writer.write(previous.text(order.popleft()[0]))
+      STATS.count("reusedfiles")
+
+  for inputfile, text, error, extents, tracks in orderedmap(pool, drawfile, makejobs()):
+    # Every file before this one has been through makejobs() by now
+    writecopied()
+    order.popleft()
+    if error is not None:
+      warn("Bad file: %s: %s" % (inputfile, error))
+      continue
+    if index is not None:
+      index.update(inputfile, extents if trackfilter is None else None, tracks)
+    writer.write(text)
+  writecopied()
+
+
+##
+## drawtiles()
+## Draw files given as (inputfile, packed, extents) tuples in tiles mode,
+## where extents is None if it isn't known yet.  Each track gets its own
+## view, and where it lands on the page depends on how many tracks came
+## before it, so the drawing is done in this process.  When a page is full,
+## nextpage() is given what was being drawn on, finishes the page and
+## returns what to draw the next one on.  Returns what the last page was
+## drawn on.  Unless there is a --simplify tolerance, points closer together
+## than TILERESOLUTION are thinned out (see thinrun()), so that tiny tiles
+## don't carry every point of a track.  With --dedup, each tile only leaves
+## out lines that are already drawn in that tile
+##
+TILERESOLUTION = 0.1    # points, the size of a dot at 720 dpi
+
+def drawtiles(writer, files, view, nextpage):
+  placed = 0
+  for inputfile, packed, extents in files:
+    start = STATS.startfile()
+    out = fileout(inputfile, view)
+    if extents is None:
+      with STATS.stage("bounds"):
+        extents = fileextents(packed)
+    for track, trackextents in zip(unpackgpx(packed), extents):
+      if placed == view.pagetiles:
+        writer.write(joinout(out, view))
+        writer = nextpage(writer)
+        out = fileout(inputfile, view)
+        placed = 0
+      xoffset = placed % view.xtiles
+      yoffset = placed // view.xtiles + 1 - view.ytiles
+      placed += 1
+
+      # The bounds of the track come from the extents of its segments
+      bounds = unionbounds(None, [trackextents])
+      if bounds is None:
+        continue    # a track without any points gets an empty tile
+      minlat, minlon, maxlat, maxlon = bounds
+      centerlat = minlat + (maxlat - minlat)/2.0
+      centerlon = minlon + (maxlon - minlon)/2.0
+      trackview = View(view.projection, centerlat, centerlon, minlat, minlon, maxlat, maxlon,
+                       view.margin, view.papersize, view.xtiles, view.ytiles,
+                       view.keeppercent, view.precision, view.simplify, view.clip, view.raster,
+                       view.fulldetail, view.dedup, view.pdf)
+      if view.simplify is None:
+        trackview.resolution = TILERESOLUTION
+      for segment in track:
+        drawsegment(detailsegment(segment, trackview.detail), trackview, xoffset, yoffset, out)
+    STATS.endfile(inputfile, start)
+    writer.write(joinout(out, view))
+  return writer
+
+
+##
+## readviews()
+## Read a --views file: a JSON list of objects, or a CSV file with a header
+## row.  Empty CSV fields are left out
+##
+def readviews(filename):
+  try:
+    with open(filename) as infile:
+      if filename.lower().endswith(".csv"):
+        views = []
+        for row in csv.DictReader(infile):
+          views.append(dict((key.strip(), value.strip()) for key, value in row.items()
+                            if key is not None and value is not None and value.strip() != ""))
+      else:
+        views = json.load(infile)
+  except (IOError, OSError, ValueError) as detail:
+    raise Gpx2psError("could not read views file: " + str(detail))
+
+  if not isinstance(views, list) or not all(isinstance(view, dict) for view in views):
+    raise Gpx2psError("views file must be a list of views")
+  return views
+
+
+##
+## parseview()
+## Turn one view from a --views file into a full set of arguments.  Fields
+## are named after the command line options, and anything a view leaves out
+## comes from the command line.  Giving any of bbox, center, radius, autofit
+## or tiles replaces all of them
+##
+VIEWFIELDS = ("bbox", "center", "radius", "autofit", "tiles", "title", "fgcolor", "bgcolor",
+              "linewidth", "orientation", "fontsize", "thinfont", "boldfont", "droppercent",
+              "simplify", "fulldetail", "dedup", "clip", "compact", "precision", "raster", "ramp", "tilesperpage", "output")
+VIEWBOXFIELDS = ("bbox", "center", "radius", "autofit", "tiles")
+VIEWFLAGS = ("autofit", "tiles", "clip", "compact", "fulldetail")
+
+def parseview(args, entry):
+  for key in entry:
+    if key not in VIEWFIELDS:
+      raise Gpx2psError("unknown field '%s' in views file" % key)
+
+  viewargs = argparse.Namespace(**vars(args))
+  viewargs.views = None
+  if any(key in entry for key in VIEWBOXFIELDS):
+    viewargs.bbox = viewargs.center = viewargs.radius = None
+    viewargs.autofit = viewargs.tiles = False
+
+  argv = []
+  for key in VIEWFIELDS:
+    if key not in entry:
+      continue
+    value = entry[key]
+    if key in VIEWFLAGS:
+      # true/false from JSON, text from CSV
+      if not isinstance(value, bool):
+        value = str(value).lower() in ("1", "true", "yes")
+      setattr(viewargs, key, False)
+      if value:
+        argv.append("--" + key)
+    elif key == "orientation":
+      if value not in ("landscape", "portrait"):
+        raise Gpx2psError("orientation must be landscape or portrait")
+      argv.append("--" + value)
+    else:
+      # --key=value, so that values such as negative latitudes aren't taken for options
+      argv.append("--%s=%s" % (key, value))
+
+  return makeparser(raiseerrors=True).parse_args(argv, namespace=viewargs)
+
+
+##
+## filestamp()
+## The size and modification time of a file, or None if it can't be found
+##
+def filestamp(inputfile):
+  try:
+    stat = inputstat(inputfile)
+  except OSError:
+    return None
+  return (stat.st_size, stat.st_mtime)
+
+
+##
+## serve()
+## --serve: draw maps from a Renderer that has every file loaded, over HTTP
+## on a TCP port (ADDRESS is HOST:PORT) or a Unix socket (ADDRESS is a path).
+## Each GET request is one map, with options taken from the query string the
+## way a --views entry gives them, on top of those from the command line:
+##
+## curl "http://localhost:8000/?center=47.604815,-122.287016&radius=13mi&title=Seattle"
+##
+## Maps are drawn one at a time in a worker thread, and the postscript is
+## sent as it is written.  The status line waits for the first chunk of it,
+## so a map that can't be drawn gets an error response instead of a 200.
+## If drawing fails after that, the connection is dropped rather than
+## ended as if the map were complete.  Every args.reload seconds the input directory is
+## checked for new, changed and removed files, in the same thread, so a map
+## is never drawn from half read files
+##
+SERVEFIELDS = tuple(key for key in VIEWFIELDS if key != "output")
+
+def serve(renderer, args, commandline):
+  try:
+    asyncio.run(serveforever(renderer, args, commandline))
+  except KeyboardInterrupt:
+    pass
+
+async def serveforever(renderer, args, commandline):
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  handler = functools.partial(servemap, renderer, args, commandline, executor)
+  try:
+    if "/" in args.serve or ":" not in args.serve:
+      server = await asyncio.start_unix_server(handler, args.serve)
+    else:
+      host, port = args.serve.rsplit(":", 1)
+      server = await asyncio.start_server(handler, host or None, int(port))
+  except (OSError, ValueError, OverflowError) as detail:
+    raise Gpx2psError("can't serve on %s: %s" % (args.serve, detail))
+  warn("Serving maps of %d files on %s" % (len(renderer.inputfiles), args.serve))
+
+  if args.reload > 0:
+    reloader = asyncio.ensure_future(reloadfiles(renderer, args, executor))
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    if args.reload > 0:
+      reloader.cancel()
+    executor.shutdown()
+
+async def reloadfiles(renderer, args, executor):
+  loop = asyncio.get_running_loop()
+  while True:
+    await asyncio.sleep(args.reload)
+    changed = await loop.run_in_executor(executor, lambda: renderer.refresh(findfiles(args.inputdir, args.recursive)))
+    if changed > 0:
+      warn("Reloaded %d changed files, now serving %d files" % (changed, len(renderer.inputfiles)))
+
+async def servemap(renderer, args, commandline, executor, reader, writer):
+  try:
+    request = await reader.readuntil(b"\r\n\r\n")
+  except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+    writer.close()
+    return
+  requestline = request.split(b"\r\n", 1)[0].decode("latin-1").split()
+  if len(requestline) != 3 or requestline[0] != "GET":
+    await respond(writer, "405 Method Not Allowed", "Only GET requests are supported\n")
+    return
+
+  target = urllib.parse.urlsplit(requestline[1])
+  entry = dict(urllib.parse.parse_qsl(target.query, keep_blank_values=True))
+  try:
+    for key in entry:
+      if key not in SERVEFIELDS:
+        raise Gpx2psError("unknown option '%s'" % key)
+    viewargs = parseview(args, entry)
+  except Gpx2psError as detail:
+    await respond(writer, "400 Bad Request", "Error: %s\n" % detail)
+    return
+
+  loop = asyncio.get_running_loop()
+  outfile = ResponseFile(loop)
+  drawing = loop.run_in_executor(executor, drawresponse, renderer, viewargs,
+                                 "%s %s" % (commandline, requestline[1]), outfile)
+  chunk = await outfile.queue.get()
+  if isinstance(chunk, Exception):
+    await drawing
+    if isinstance(chunk, Gpx2psError):
+      await respond(writer, "400 Bad Request", "Error: %s\n" % chunk)
+    else:
+      warn("Error drawing %s: %s" % (requestline[1], chunk))
+      await respond(writer, "500 Internal Server Error", "Error: %s\n" % chunk)
+    return
+
+  contenttype = "application/pdf" if args.format == "pdf" else "application/postscript"
+  writer.write(("HTTP/1.0 200 OK\r\nContent-Type: %s\r\n\r\n" % contenttype).encode("ascii"))
+  failed = None
+  while chunk is not None:
+    if isinstance(chunk, Exception):
+      failed = chunk
+    elif not outfile.cancelled:    # once the client has gone the queue still has to be emptied
+      try:
+        writer.write(chunk)
+        await writer.drain()
+      except ConnectionError:
+        outfile.cancelled = True
+    chunk = await outfile.queue.get()
+  await drawing
+  if failed is not None:
+    warn("Error drawing %s: %s" % (requestline[1], failed))
+    abort(writer)
+  else:
+    writer.close()
+
+def abort(writer):
+  # Reset a TCP connection, so that the client sees an error instead of the
+  # end of the response
+  sock = writer.get_extra_info("socket")
+  if sock is not None and sock.family != socket.AF_UNIX:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+  writer.transport.abort()
+
+async def respond(writer, status, text):
+  try:
+    writer.write(("HTTP/1.0 %s\r\nContent-Type: text/plain\r\n\r\n%s" % (status, text)).encode("utf-8"))
+    await writer.drain()
+  except ConnectionError:
+    pass
+  writer.close()
+
+def drawresponse(renderer, viewargs, commandline, outfile):
+  # Runs in the worker thread.  The map is put on the queue in chunks,
+  # followed by the exception if drawing it failed, and then None
+  try:
+    view = renderer.makeview(viewargs)
+    renderer.render(outfile, viewargs, commandline, view)
+    outfile.flush()
+  except ClientGone:
+    pass
+  except Exception as detail:
+    outfile.put(detail)
+  finally:
+    outfile.put(None)
+
+
+##
+## ResponseFile
+## What a served map is written to, in the worker thread.  Text (or bytes,
+## for PDF) is gathered into chunks and handed to the event loop through a
+## short queue, so a slow client holds up the drawing instead of the whole
+## map piling up in memory.  Writing raises ClientGone once the client has
+## stopped listening
+##
+class ClientGone(Exception):
+  pass
+
+class ResponseFile(object):
+  CHUNK = 64 * 1024
+
+  def __init__(self, loop):
+    self.loop = loop
+    self.queue = asyncio.Queue(maxsize=8)
+    self.encoding = locale.getpreferredencoding(False)
+    self.buffer = []
+    self.size = 0
+    self.cancelled = False
+
+  def write(self, text):
+    if self.cancelled:
+      raise ClientGone()
+    if not isinstance(text, bytes):
+      text = text.encode(self.encoding)
+    self.buffer.append(text)
+    self.size += len(text)
+    if self.size >= self.CHUNK:
+      self.flush()
+    return len(text)
+
+  def flush(self):
+    if len(self.buffer) > 0:
+      data = b"".join(self.buffer)
+      self.buffer = []
+      self.size = 0
+      self.put(data)
+
+  def put(self, item):
+    asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+
+##
+## PreviousOutput
+## An earlier output of gpx2ps, for --incremental.  The postscript for each
+## input file starts with a "% File:" line, so a quick scan finds where each
+## file's postscript is without holding it all in memory.  The line also
+## gives the file's size and modification time (see fileout()), and a file
+## is unchanged if it was in the previous output with exactly the size and
+## modification time it has now.  Files in outputs written before the stamp
+## was recorded always count as changed
+##
+FILESTAMP = re.compile(r"^(.*) % (\d+) (\S+)$")
+
+class PreviousOutput(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.arguments = None
+    self.databounds = None
+    self.blocks = {}    # inputfile -> (offset, length)
+    self.stamps = {}    # inputfile -> (size, mtime)
+    self.infile = None
+    self.encoding = locale.getpreferredencoding(False)    # what openoutput() writes in
+
+    try:
+      infile = open(filename, "rb")
+    except (IOError, OSError) as detail:
+      raise Gpx2psError(str(detail))
+
+    with infile:
+      offset = 0
+      current = None
+      for line in infile:
+        if line.startswith((b"% File: ", b"% Title stuff", b"%%Page:")):
+          if current is not None:
+            self.blocks[current] = (start, offset - start)
+            current = None
+          if line.startswith(b"%%Page:"):
+            raise Gpx2psError("%s has more than one page, so it can't be brought up to date" % filename)
+          if not line.startswith(b"% File: "):
+            break
+          current = line[8:].rstrip(b"\r\n").decode(self.encoding)
+          result = FILESTAMP.search(current)
+          if result != None:
+            current = result.group(1)
+            self.stamps[current] = (int(result.group(2)), float(result.group(3)))
+          start = offset
+        elif len(self.blocks) == 0 and current is None:
+          if line.startswith(b"% argumentlist "):
+            self.arguments = json.loads(line[15:].decode(self.encoding))
+          elif line.startswith(b"% autofitbounds "):
+            self.databounds = tuple(json.loads(line[16:].decode(self.encoding)))
+        offset += len(line)
+      if current is not None:
+        self.blocks[current] = (start, offset - start)
+
+    if self.arguments is None:
+      raise Gpx2psError("no argument line found in %s" % filename)
+
+  def isfile(self, filename):
+    try:
+      return filename is not None and os.path.samefile(filename, self.filename)
+    except OSError:
+      return False
+
+  def unchanged(self, inputfile):
+    if inputfile not in self.blocks or inputfile not in self.stamps:
+      return False
+    return filestamp(inputfile) == self.stamps[inputfile]
+
+  def text(self, inputfile):
+    offset, length = self.blocks[inputfile]
+    if self.infile is None:
+      self.infile = open(self.filename, "rb")
+    self.infile.seek(offset)
+    return self.infile.read(length).decode(self.encoding)
+
+  def close(self):
+    if self.infile is not None:
+      self.infile.close()
+      self.infile = None
+
+
+##
+## writeoutput()
+## Write a chunk of postscript, keeping track of how long it took and how
+## much was written
+##
+def writeoutput(outfile, text):
+  with STATS.stage("write"):
+    outfile.write(text)
+  if STATS.enabled:
+    if not isinstance(text, bytes) and not text.isascii():
+      text = text.encode(getattr(outfile, "encoding", None) or "utf-8", "replace")
+    STATS.count("bytes", len(text))
+
+
+##
+## openoutput()
+## Open the file the output goes to, or standard output if there isn't one,
+## with a large buffer so that it is written out in big chunks.  It takes
+## text for postscript and bytes for PDF
+##
+OUTPUTBUFFER = 1024 * 1024
+
+def openoutput(filename, format="ps"):
+  mode = "wb" if format == "pdf" else "w"
+  try:
+    if filename is None:
+      sys.stdout.flush()
+      return io.open(sys.stdout.fileno(), mode, buffering=OUTPUTBUFFER, closefd=False)
+    return io.open(filename, mode, buffering=OUTPUTBUFFER)
+  except (IOError, OSError) as detail:
+    raise Gpx2psError(str(detail))
+
+
+##
+## GpxReader
+## An expat handler that reads the points of a GPX file straight into packed
+## form (see unpackgpx()), without making an object for each element or point.
+## GPXCHAIN is the path of elements down to a track point; everything else is
+## skipped, apart from the <name> and <type> of each track and the <time> of
+## its first point, which are kept in tracks as [name, type, start] with
+## start in seconds since 1970.  Given a TrackFilter, tracks it doesn't let
+## through are left out of the packed points, and their points aren't read
+## from the moment that is known
+##
+GPXCHAIN = ("gpx", "trk", "trkseg", "trkpt")
+
+class GpxReader(object):
+  def __init__(self, trackfilter=None):
+    self.depth = 0    # depth of the current element in the document
+    self.level = 0    # how many elements of GPXCHAIN we are currently inside
+    self.lengths = []
+    self.coords = array.array('d')
+    self.segmentstart = 0
+    self.tracks = []
+    self.trackfilter = trackfilter
+    self.trackstart = 0
+    self.skipping = False   # whether the current track has been filtered out
+    self.field = None       # which of name, type or start the text being collected is for
+    self.text = []
+    self.parser = None
+
+  def startelement(self, tag, attrib):
+    self.depth += 1
+    depth = self.depth
+    if self.level != depth - 1:
+      return
+    if depth <= 4 and tag.endswith(GPXCHAIN[depth - 1]):
+      self.level = depth
+      if depth == 4:
+        if not self.skipping:
+          self.coords.append(float(attrib['lat']))
+          self.coords.append(float(attrib['lon']))
+      elif depth == 3:
+        self.segmentstart = len(self.coords)
+      elif depth == 2:
+        self.lengths.append([])
+        self.tracks.append([None, None, None])
+        self.trackstart = len(self.coords)
+        self.skipping = False
+    elif depth == 3 and tag.endswith(("name", "type")):
+      self.collect(0 if tag.endswith("name") else 1)
+    elif depth == 5 and self.tracks[-1][2] is None and tag.endswith("time"):
+      self.collect(2)
+
+  def collect(self, field):
+    # Start collecting the text of an element for tracks[-1][field]
+    self.field = field
+    self.text = []
+    self.parser.CharacterDataHandler = self.text.append
+
+  def endelement(self, tag):
+    depth = self.depth
+    if self.field is not None:
+      self.parser.CharacterDataHandler = None
+      self.fieldread("".join(self.text).strip())
+      self.field = None
+    if self.level == depth:
+      self.level = depth - 1
+      if depth == 3:
+        if not self.skipping:
+          self.lengths[-1].append((len(self.coords) - self.segmentstart) // 2)
+      elif depth == 2:
+        if self.skipping or (self.trackfilter is not None and not self.trackfilter.matches(self.tracks[-1])):
+          del self.coords[self.trackstart:]
+          self.lengths.pop()
+    self.depth = depth - 1
+
+  def fieldread(self, value):
+    track = self.tracks[-1]
+    if self.field == 2:
+      track[2] = parsetime(value)
+    else:
+      track[self.field] = value
+    # Stop reading the points of a track as soon as it is known to be unwanted
+    if self.trackfilter is not None and not self.skipping and not self.trackfilter.matchesfield(self.field, track[self.field]):
+      self.skip()
+    elif self.skipping and self.field == 2:
+      self.skiprest()
+
+  def skip(self):
+    self.skipping = True
+    del self.coords[self.trackstart:]
+    if self.tracks[-1][2] is not None:
+      self.skiprest()
+
+  def skiprest(self):
+    # Once everything kept in tracks is known, nothing more is needed from a
+    # track that has been filtered out, so the elements in it are passed
+    # over until the end of the track, which can't contain another one
+    self.parser.StartElementHandler = None
+    self.parser.EndElementHandler = self.skipend
+
+  def skipend(self, tag):
+    if tag.endswith(GPXCHAIN[1]) and (len(tag) == 3 or tag[-4] == ":"):
+      self.parser.StartElementHandler = self.startelement
+      self.parser.EndElementHandler = self.endelement
+      self.depth = self.level = 2
+      self.endelement(tag)
+
+  def read(self, source):
+    # source is a file name or a file object opened in binary mode
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = self.startelement
+    parser.EndElementHandler = self.endelement
+    self.parser = parser
+    if hasattr(source, "read"):
+      parser.ParseFile(source)
+    else:
+      with openinput(source) as infile:
+        parser.ParseFile(infile)
+    self.parser = None
+    return (self.lengths, self.coords)
+
+
+##
+## TrackFilter
+## Which tracks to draw: those starting at or after since and before until
+## (in seconds since 1970, either of which can be None), whose name and
+## type match the shell-style patterns name and type, ignoring case.  A
+## track whose start, name or type isn't known doesn't get through a filter
+## on it
+##
+class TrackFilter(object):
+  def __init__(self, since=None, until=None, name=None, type=None):
+    self.since = since
+    self.until = until
+    self.patterns = [None, None]
+    for field, pattern in enumerate((name, type)):
+      if pattern is not None:
+        self.patterns[field] = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+
+  def matchesfield(self, field, value):
+    # field is 0, 1 or 2 for the name, type or start of a track
+    if field == 2:
+      if self.since is None and self.until is None:
+        return True
+      return (value is not None and (self.since is None or value >= self.since) and
+              (self.until is None or value < self.until))
+    pattern = self.patterns[field]
+    return pattern is None or (value is not None and pattern.match(value) is not None)
+
+  def matches(self, track):
+    # track is [name, type, start], as GpxReader keeps them
+    return all(self.matchesfield(field, track[field]) for field in range(3))
+
+
+##
+## makefilter()
+## The TrackFilter for the --since, --until, --name and --type options, or
+## None if none of them are given.  A date on its own runs --until to the
+## end of that day
+##
+def makefilter(args):
+  if args.since == None and args.until == None and args.name == None and args.type == None:
+    return None
+  since = until = None
+  if args.since != None:
+    since = parsedate(args.since)
+  if args.until != None:
+    until = parsedate(args.until)
+    if re.match(r"^\d{4}-\d\d-\d\d$", args.until):
+      until += 86400
+    else:
+      until += 1
+  if since is not None and until is not None and since >= until:
+    raise Gpx2psError("--since must be before --until")
+  return TrackFilter(since, until, args.name, args.type)
+
+
+##
+## filterpacked()
+## The packed points (see unpackgpx()) of just the tracks a TrackFilter lets
+## through, given the [name, type, start] of every track
+##
+def filterpacked(packed, tracks, trackfilter):
+  lengths, coords = packed
+  keptlengths = []
+  keptcoords = array.array('d')
+  i = 0
+  for segmentlengths, track in zip(lengths, tracks):
+    n = 2 * sum(segmentlengths)
+    if trackfilter.matches(track):
+      keptlengths.append(segmentlengths)
+      keptcoords.extend(coords[i:i + n])
+    i += n
+  return (keptlengths, keptcoords)
+
+
+##
+## readdeclaredbounds()
+## The (minlat, minlon, maxlat, maxlon) a GPX file declares in its <bounds>
+## element, under <metadata> in GPX 1.1 or straight under <gpx> in GPX 1.0.
+## Only the header is read: reading stops at the first waypoint, route or
+## track.  Returns None if there is no <bounds> or it can't be believed
+##
+class EndOfHeader(Exception):
+  pass
+
+def readdeclaredbounds(inputfile):
+  found = []
+  path = []
+
+  def startelement(tag, attrib):
+    tag = tag.rsplit(":", 1)[-1]
+    path.append(tag)
+    if len(path) == 2 and tag in ("wpt", "rte", "trk"):
+      raise EndOfHeader()
+    if tag == "bounds" and path[:-1] in (["gpx"], ["gpx", "metadata"]):
+      found.append(attrib)
+      raise EndOfHeader()
+
+  def endelement(tag):
+    path.pop()
+
+  parser = expat.ParserCreate()
+  parser.StartElementHandler = startelement
+  parser.EndElementHandler = endelement
+  try:
+    with openinput(inputfile) as infile:
+      parser.ParseFile(infile)
+  except (EndOfHeader, expat.ExpatError, DecompressError, IOError, OSError):
+    pass
+  if len(found) == 0:
+    return None
+
+  try:
+    minlat, minlon, maxlat, maxlon = [float(found[0][name]) for name in ("minlat", "minlon", "maxlat", "maxlon")]
+  except (KeyError, ValueError):
+    return None
+  if not (-90 <= minlat <= maxlat <= 90 and -180 <= minlon <= maxlon <= 180):
+    return None
+  return (minlat, minlon, maxlat, maxlon)
+
+
+##
+## parsefile()
+## Read a file and pack its points, returning (inputfile, packed, error,
+## tracks), where tracks is the [name, type, start] of every track in the
+## file, as GpxReader keeps them.  error is None unless the file couldn't be
+## parsed, in which case packed and tracks are None instead.  Given a
+## TrackFilter, packed only has the tracks it lets through, and it is at
+## the given level of detail (see detailpyramid()).  If given a TrackCache
+## it is checked before the file is read, and the whole file is read so
+## that it can be cached along with its detail pyramid
+##
+def parsefile(inputfile, cache=None, trackfilter=None, detail=0):
+  start = STATS.startfile()
+  if cache is not None:
+    with STATS.stage("cache"):
+      cached = cache.get(inputfile, detail)
+    if cached is not None:
+      packed, tracks = cached
+      STATS.count("cachedfiles")
+      if trackfilter is not None:
+        packed = filterpacked(packed, tracks, trackfilter)
+      countparsed(packed, tracks)
+      STATS.endfile(inputfile, start)
+      return (inputfile, packed, None, tracks)
+
+  reader = GpxReader(trackfilter if cache is None else None)
+  try:
+    with STATS.stage("parse"):
+      packed = reader.read(inputfile)
+  except (expat.ExpatError, DecompressError) as detail:
+    STATS.count("badfiles")
+    return (inputfile, None, str(detail), None)
+  STATS.count("parsedfiles")
+  tracks = reader.tracks
+
+  if cache is not None:
+    pyramid = detailpyramid(packed)
+    with STATS.stage("cache"):
+      cache.put(inputfile, pyramid, tracks)
+    packed = pyramid[detail]
+    if trackfilter is not None:
+      packed = filterpacked(packed, tracks, trackfilter)
+  elif detail > 0:
+    packed = detailpyramid(packed, detail)[detail]
+  countparsed(packed, tracks)
+  STATS.endfile(inputfile, start)
+  return (inputfile, packed, None, tracks)
+
+def countparsed(packed, tracks):
+  STATS.count("points", len(packed[1]) // 2)
+  STATS.count("tracks", len(packed[0]))
+  STATS.count("filteredtracks", len(tracks) - len(packed[0]))
+
+
+##
+## readfiles()
+## Parse each of the given files, in parallel if given a pool, yielding
+## (inputfile, packed) pairs in order.  Files that can't be parsed are warned
+## about and skipped.  Given a TrackIndex, what was learnt about the tracks
+## of each file is recorded in it
+##
+def readfiles(inputfiles, pool=None, cache=None, trackfilter=None, index=None):
+  parse = functools.partial(parsefile, cache=cache, trackfilter=trackfilter)
+  for inputfile, packed, error, tracks in orderedmap(pool, parse, inputfiles):
+    if error is not None:
+      warn("Bad file: %s: %s" % (inputfile, error))
+      continue
+    if index is not None:
+      index.update(inputfile, tracks=tracks)
+    yield (inputfile, packed)
+
+
+##
+## drawfile()
+## Draw every track of one file, returning (inputfile, text, error, extents,
+## tracks), where tracks is as parsefile() returns it if the file was read
+## and None if it wasn't.  The argument is an (inputfile, packed, view, cache,
+## extents, trackfilter) tuple so it can be handed to a worker process.
+## packed is at the view's level of detail.  If packed is None the file is
+## read first, with the TrackFilter if there is one.  If the file's extents
+## (see fileextents()) are already known, segments that are entirely off the
+## map are skipped, and the file isn't read at all if none of them are on it
+##
+def drawfile(job):
+  inputfile, packed, view, cache, extents, trackfilter = job
+  out = fileout(inputfile, view)
+  if extents is not None and not fileoverlaps(extents, view):
+    if len(extents) > 0:
+      STATS.count("skippedfiles")
+    return (inputfile, joinout(out, view), None, extents, None)
+
+  tracks = None
+  if packed is None:
+    inputfile, packed, error, tracks = parsefile(inputfile, cache, trackfilter, view.detail)
+    if error is not None:
+      return (inputfile, None, error, None, None)
+  if extents is None:
+    extents = fileextents(packed)
+
+  start = STATS.startfile()
+  for track, trackextents in zip(unpackgpx(packed), extents):
+    for segment, bounds in zip(track, trackextents):
+      if overlaps(bounds, view):
+        drawsegment(segment, view, 0, 1 - view.ytiles, out)
+      else:
+        STATS.count("outside", len(segment))
+  STATS.endfile(inputfile, start)
+  return (inputfile, joinout(out, view), None, extents, tracks)
+
+
+##
+## fileout()
+## What drawfile() starts a file's output with: a comment saying which file
+## it is and its size and modification time (see filestamp()), which
+## --incremental checks to tell whether it has changed.  It is stamped
+## before the file is read, so a change made while it is being read is
+## picked up next time.  There is no comment in --raster mode, where there
+## is no postscript until the end
+##
+def fileout(inputfile, view):
+  if view.raster is not None:
+    return []
+  stamp = filestamp(inputfile)
+  if stamp is None:
+    return ["%% File: %s\n" % inputfile]
+  return ["%% File: %s %% %d %r\n" % ((inputfile,) + stamp)]
+
+
+##
+## fileextents()
+## Find the (minlat, minlon, maxlat, maxlon) bounds of each segment of a
+## packed file, returned as a list of lists like the segment lengths.
+## Segments without any points get None
+##
+def fileextents(packed):
+  lengths, coords = packed
+  extents = []
+  i = 0
+  for segmentlengths in lengths:
+    trackextents = []
+    for length in segmentlengths:
+      if length > 0:
+        trackextents.append(pointbounds(coords, i, length))
+      else:
+        trackextents.append(None)
+      i += 2*length
+    extents.append(trackextents)
+  return extents
+
+
+##
+## scantracks()
+## The number of tracks in a GPX file, found by counting the tags that end
+## them rather than parsing the file.  Much quicker than reading the points,
+## but can be fooled by a file that isn't well formed.  The file is read
+## SCANCHUNK bytes at a time, and a tag cut off at the end of one chunk is
+## carried over to the next if it started in the last SCANTAIL bytes
+##
+TRACKEND = re.compile(br"</(?:[\w.-]+:)?trk\s*>")
+SCANCHUNK = 1 << 20
+SCANTAIL = 256
+
+def scantracks(inputfile):
+  ntracks = 0
+  tail = b""
+  try:
+    with openinput(inputfile) as infile:
+      while True:
+        chunk = infile.read(SCANCHUNK)
+        if len(chunk) == 0:
+          break
+        data = tail + chunk
+        if b":trk" in data:
+          # A namespace prefix, which plain counting would miss
+          ntracks += len(TRACKEND.findall(data))
+        else:
+          ntracks += data.count(b"</trk>")
+        last = data.rfind(b"<", max(len(data) - SCANTAIL, 0))
+        if last >= 0 and b">" not in data[last:]:
+          tail = data[last:]
+        else:
+          tail = b""
+  except (DecompressError, IOError, OSError):
+    return 0
+  return ntracks
+
+
+##
+## pointbounds()
+## The (minlat, minlon, maxlat, maxlon) bounds of length points of a packed
+## coords array, starting at index start.  Longer runs are done with numpy
+## when it is available, on a view of the array rather than a copy
+##
+NUMPYBOUNDS = 64    # points
+
+def pointbounds(coords, start, length):
+  if numpy is not None and length >= NUMPYBOUNDS:
+    points = numpy.frombuffer(coords, dtype=numpy.float64, count=2*length,
+                              offset=start*coords.itemsize).reshape(length, 2)
+    lats = points[:, 0]
+    lons = points[:, 1]
+    return (float(lats.min()), float(lons.min()), float(lats.max()), float(lons.max()))
+  lats = coords[start:start + 2*length:2]
+  lons = coords[start + 1:start + 2*length:2]
+  return (min(lats), min(lons), max(lats), max(lons))
+
+
+##
+## detailpyramid()
+## A file's level of detail pyramid: its packed points (see unpackgpx()) at
+## levels 0 to top, where level 0 is every point.  At level L a segment
+## keeps its first and last points, the points where it reaches furthest
+## north, south, east and west, and each point that is in a different cell
+## of a grid DETAILCELL * 2**L degrees across from the point before it.  A
+## point that is dropped is in the same cell as the last point kept, so the
+## line is never moved by more than a cell in latitude and longitude, and
+## the extents of every segment are the same at every level.  The cells of
+## a level are made of whole cells of the level below, so a level built from
+## any level below it is the same as one built from every point.  A segment
+## that would keep more than half of its points from the level below isn't
+## worth thinning and stays as it is, and a level where that is true of
+## every segment is the level below.  View picks the level to draw from
+##
+DETAILCELL = 0.00001    # degrees
+DETAILLEVELS = 12
+
+def detailpyramid(packed, top=DETAILLEVELS):
+  pyramid = [packed]
+  while len(pyramid) <= top:
+    thinned = thinlevel(pyramid[-1], len(pyramid))
+    pyramid.append(thinned if thinned is not None else pyramid[-1])
+  return pyramid
+
+def thinlevel(below, level):
+  # Level 'level' built from the level below it, or None if it is the same.
+  # With numpy the whole file is done at once, keeping the same points
+  # detailsegment() would
+  lengths, coords = below
+  if numpy is None:
+    return thinsegments(below, level)
+
+  with STATS.stage("detail"):
+    seglengths = numpy.array([length for segmentlengths in lengths for length in segmentlengths], dtype=numpy.int64)
+    npoints = len(coords) // 2
+    if npoints == 0:
+      return None
+    points = numpy.frombuffer(coords, dtype=numpy.float64).reshape(npoints, 2)
+    cells = numpy.floor(points / (DETAILCELL * 2**level))
+    keep = numpy.empty(npoints, dtype=bool)
+    keep[0] = True
+    numpy.any(cells[1:] != cells[:-1], axis=1, out=keep[1:])
+    ends = numpy.cumsum(seglengths)
+    starts = ends - seglengths
+
+    # Segments that aren't worth thinning keep every point.  Keeping the
+    # ends and extremes of a segment only adds to what it keeps, so
+    # segments that aren't worth thinning without them can be left alone
+    whole = (seglengths < 3) | (2*keptcounts(keep, starts, ends) > seglengths)
+    if whole.all():
+      return None
+    for start, end in zip(starts[~whole].tolist(), ends[~whole].tolist()):
+      segment = points[start:end]
+      keep[start] = True
+      keep[end - 1] = True
+      keep[start + segment.argmin(axis=0)] = True
+      keep[start + segment.argmax(axis=0)] = True
+    keptlengths = keptcounts(keep, starts, ends)
+    whole |= 2*keptlengths > seglengths
+    if whole.all():
+      return None
+    keep |= numpy.repeat(whole, seglengths)
+    keptlengths = numpy.where(whole, seglengths, keptlengths).tolist()
+    keptcoords = array.array('d')
+    keptcoords.frombytes(points[keep].tobytes())
+
+  packedlengths = []
+  i = 0
+  for segmentlengths in lengths:
+    packedlengths.append(keptlengths[i:i + len(segmentlengths)])
+    i += len(segmentlengths)
+  return (packedlengths, keptcoords)
+
+def keptcounts(keep, starts, ends):
+  # How many points of each segment are kept
+  total = numpy.concatenate(([0], numpy.cumsum(keep)))
+  return total[ends] - total[starts]
+
+def thinsegments(below, level):
+  keptlengths = []
+  keptcoords = array.array('d')
+  thinned = False
+  with STATS.stage("detail"):
+    for track in unpackgpx(below):
+      tracklengths = []
+      for segment in track:
+        kept = detailsegment(segment, level)
+        if len(segment) < 3 or 2*len(kept) > len(segment):
+          kept = segment
+        else:
+          thinned = True
+        tracklengths.append(len(kept))
+        keptcoords.extend(kept.coords[kept.start:kept.start + 2*len(kept)])
+      keptlengths.append(tracklengths)
+  if not thinned:
+    return None
+  return (keptlengths, keptcoords)
+
+
+##
+## detailsegment()
+## The points of a Segment that are kept at a level of detail (see
+## detailpyramid()), as a Segment of their own.  Longer segments are done
+## with numpy when it is available
+##
+def detailsegment(segment, level):
+  length = len(segment)
+  if level == 0 or length < 3:
+    return segment
+  cell = DETAILCELL * 2**level
+
+  if numpy is not None and length >= NUMPYBOUNDS:
+    points = numpy.frombuffer(segment.coords, dtype=numpy.float64, count=2*length,
+                              offset=segment.start*segment.coords.itemsize).reshape(length, 2)
+    cells = numpy.floor(points / cell)
+    keep = numpy.empty(length, dtype=bool)
+    keep[0] = True
+    numpy.any(cells[1:] != cells[:-1], axis=1, out=keep[1:])
+    keep[-1] = True
+    keep[points.argmin(axis=0)] = True
+    keep[points.argmax(axis=0)] = True
+    coords = array.array('d')
+    coords.frombytes(points[keep].tobytes())
+    return Segment(coords, 0, len(coords) // 2)
+
+  lats = segment.lats
+  lons = segment.lons
+  extremes = set((0, length - 1, lats.index(min(lats)), lats.index(max(lats)),
+                  lons.index(min(lons)), lons.index(max(lons))))
+  coords = array.array('d')
+  last = None
+  for i, lat, lon in zip(range(length), lats, lons):
+    # x // 1 is floor(x), as a float like numpy.floor() gives
+    here = (lat / cell // 1, lon / cell // 1)
+    if here != last or i in extremes:
+      coords.append(lat)
+      coords.append(lon)
+    last = here
+  return Segment(coords, 0, len(coords) // 2)
+
+
+##
+## detaillevel()
+## The coarsest level of a detail pyramid (see detailpyramid()) that a view
+## can be drawn from without it showing, where no line moves by more than
+## DETAILRESOLUTION on the page.  How far a cell moves a line comes from the
+## view's scale, given by minx/maxx, miny/maxy and the paper size, and the
+## most a degree of latitude or longitude is stretched anywhere on the map
+##
+DETAILRESOLUTION = 0.25   # points, about the finest detail the eye can make out on paper
+
+def detaillevel(view):
+  project = view.projection.func
+  step = 0.001    # degrees
+  latscale = 0.0  # most points on the page per degree
+  lonscale = 0.0
+  try:
+    xscale = (float(view.papersize[1])/view.xtiles - 2*view.margin) / (view.maxx - view.minx)
+    yscale = (float(view.papersize[0])/view.ytiles - 2*view.margin) / (view.maxy - view.miny)
+    for lat in (view.minlat, view.centerlat, view.maxlat):
+      for lon in (view.minlon, view.centerlon, view.maxlon):
+        x, y = project(view.centerlat, view.centerlon, lat, lon)
+        latx, laty = project(view.centerlat, view.centerlon, lat + step, lon)
+        lonx, lony = project(view.centerlat, view.centerlon, lat, lon + step)
+        latscale = max(latscale, math.hypot((latx - x)*xscale, (laty - y)*yscale) / step)
+        lonscale = max(lonscale, math.hypot((lonx - x)*xscale, (lony - y)*yscale) / step)
+  except (ValueError, ZeroDivisionError, OverflowError):
+    return 0
+
+  level = 0
+  while level < DETAILLEVELS and DETAILCELL * 2**(level + 1) * (latscale + lonscale) <= DETAILRESOLUTION:
+    level += 1
+  return level
+
+
+##
+## fileoverlaps()
+## Could any segment with these extents be inside the view's bounding box?
+##
+def fileoverlaps(extents, view):
+  return any(overlaps(bounds, view) for track in extents for bounds in track)
+
+
+##
+## overlaps()
+## Could any point within these bounds be inside the view's bounding box?
+## Mirrors the strict comparisons drawsegment() uses
+##
+def overlaps(bounds, view):
+  if bounds is None:
+    return False
+  minlat, minlon, maxlat, maxlon = bounds
+  return (maxlat > view.minlat and minlat < view.maxlat and
+          maxlon > view.minlon and minlon < view.maxlon)
+
+
+##
+## orderedmap()
+## Like map(), but runs func in the given process pool when there is one.
+## Results come back in the same order as the arguments, and no more than
+## POOLWINDOW arguments are handed out ahead of the results being consumed.
+## When STATS is enabled, what the workers record is merged back into it
+##
+POOLWINDOW = 128
+
+def orderedmap(pool, func, iterable):
+  if pool is None:
+    for item in iterable:
+      yield func(item)
+    return
+
+  if STATS.enabled:
+    call = functools.partial(instrumented, func)
+  else:
+    call = func
+
+  pending = collections.deque()
+  for item in iterable:
+    pending.append(pool.apply_async(call, (item,)))
+    if len(pending) >= POOLWINDOW:
+      yield collectresult(pending.popleft().get())
+  while pending:
+    yield collectresult(pending.popleft().get())
+
+def instrumented(func, item):
+  # Runs in a worker: record stats for just this call and send them back
+  STATS.enabled = True
+  STATS.clear()
+  result = func(item)
+  return (result, STATS.snapshot())
+
+def collectresult(result):
+  if not STATS.enabled:
+    return result
+  result, snapshot = result
+  STATS.merge(snapshot)
+  return result
+
+
+##
+## unpackgpx()
+## Convert the packed form of a file's tracks, a (lengths, coords) tuple
+## where lengths holds the number of points in each segment of each track
+## and coords is an array of lat, lon pairs, to nested lists of tracks and
+## segments.  The segments are Segments sharing the packed array
+##
+def unpackgpx(packed):
+  lengths, coords = packed
+  gpx = []
+  i = 0
+  for segmentlengths in lengths:
+    track = []
+    for length in segmentlengths:
+      track.append(Segment(coords, i, length))
+      i += 2*length
+    gpx.append(track)
+  return gpx
+
+
+##
+## Segment
+## A track segment held as length lat, lon pairs starting at start in an
+## array shared with the rest of the file.  It can be used like a list of
+## (lat, lon) tuples, but lats and lons give the latitudes and longitudes as
+## arrays without making a tuple for each point, which is how the drawing
+## code reads it
+##
+class Segment(object):
+  __slots__ = ("coords", "start", "length")
+
+  def __init__(self, coords, start, length):
+    self.coords = coords
+    self.start = start
+    self.length = length
+
+  def __len__(self):
+    return self.length
+
+  @property
+  def lats(self):
+    return self.coords[self.start:self.start + 2*self.length:2]
+
+  @property
+  def lons(self):
+    return self.coords[self.start + 1:self.start + 2*self.length:2]
+
+  def __iter__(self):
+    return zip(self.lats, self.lons)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.length
+    if i < 0 or i >= self.length:
+      raise IndexError("segment index out of range")
+    return (self.coords[self.start + 2*i], self.coords[self.start + 2*i + 1])
+
+  def take(self, indices):
+    # A new Segment with just the points at these indices
+    coords = array.array('d')
+    for i in indices:
+      coords.append(self.coords[self.start + 2*i])
+      coords.append(self.coords[self.start + 2*i + 1])
+    return Segment(coords, 0, len(indices))
+
+
+##
+## PointStore
+## Holds the tracks of every parsed file in packed form (see unpackgpx()), so
+## that a file only has to be parsed once even when its points are needed twice.
+## The extents of each file (see fileextents()) and the overall bounds are
+## worked out as files are added.  The levels of a file's detail pyramid
+## (see detailpyramid()) are built the first time they are asked for and
+## kept alongside its points.  Once the arrays held in memory grow past
+## 'limit' bytes they are spilled to a temporary file.
+##
+class PointStore(object):
+  def __init__(self, limit):
+    self.limit = limit
+    self.bounds = None    # (minlat, minlon, maxlat, maxlon)
+    self.entries = []     # [inputfile, extents, [[segment lengths per track, coords] for each level]]
+    self.positions = {}   # inputfile -> index into entries
+    self.inmemory = 0     # bytes of coords not yet spilled
+    self.spillfile = None
+
+  def add(self, inputfile, packed):
+    with STATS.stage("bounds"):
+      extents = fileextents(packed)
+      self.bounds = unionbounds(self.bounds, extents)
+    self.positions[inputfile] = len(self.entries)
+    self.entries.append([inputfile, extents, [[packed[0], packed[1]]]])
+    self.inmemory += len(packed[1]) * packed[1].itemsize
+    if self.inmemory > self.limit:
+      self.spill()
+
+  def remove(self, inputfile):
+    # Forget a file.  If its points were spilled they stay in the spill file
+    # until it is closed
+    position = self.positions.pop(inputfile, None)
+    if position is None:
+      return
+    for level in self.distinct(self.entries[position][2]):
+      if isinstance(level[1], array.array):
+        self.inmemory -= len(level[1]) * level[1].itemsize
+    self.entries[position] = None
+    self.bounds = None
+    for entry in self.entries:
+      if entry is not None:
+        self.bounds = unionbounds(self.bounds, entry[1])
+
+  def distinct(self, levels):
+    # Levels that aren't worth keeping share the list of the level below
+    return [level for i, level in enumerate(levels) if i == 0 or level is not levels[i - 1]]
+
+  def spill(self):
+    # Move every in-memory array out to the spill file, leaving behind the
+    # offset and number of values needed to read it back
+    if self.spillfile is None:
+      self.spillfile = tempfile.TemporaryFile(prefix="gpx2ps")
+    self.spillfile.seek(0, os.SEEK_END)
+    for entry in self.entries:
+      if entry is None:
+        continue
+      for level in self.distinct(entry[2]):
+        if isinstance(level[1], array.array):
+          offset = self.spillfile.tell()
+          level[1].tofile(self.spillfile)
+          level[1] = (offset, len(level[1]))
+    self.inmemory = 0
+
+  def close(self):
+    if self.spillfile is not None:
+      self.spillfile.close()
+      self.spillfile = None
+
+  def __contains__(self, inputfile):
+    return inputfile in self.positions
+
+  def get(self, inputfile, detail=0):
+    # The (inputfile, packed, extents) of one file, or None if it isn't
+    # held, with packed at the given level of detail
+    position = self.positions.get(inputfile)
+    if position is None:
+      return None
+    return self.unpack(self.entries[position], detail)
+
+  def unpack(self, entry, detail=0):
+    inputfile, extents, levels = entry
+    packed = self.points(levels[min(detail, len(levels) - 1)])
+    while len(levels) <= detail:
+      thinned = thinlevel(packed, len(levels))
+      if thinned is None:
+        levels.append(levels[-1])
+      else:
+        packed = thinned
+        levels.append([packed[0], packed[1]])
+        self.inmemory += len(packed[1]) * packed[1].itemsize
+    if self.inmemory > self.limit:
+      self.spill()
+    return (inputfile, packed, extents)
+
+  def points(self, level):
+    lengths, coords = level
+    if not isinstance(coords, array.array):
+      offset, count = coords
+      coords = array.array('d')
+      self.spillfile.seek(offset)
+      coords.fromfile(self.spillfile, count)
+    return (lengths, coords)
+
+  def __iter__(self):
+    # Yield (inputfile, packed, extents) tuples in the order the files were added
+    for entry in self.entries:
+      if entry is not None:
+        yield self.unpack(entry)
+
+
+##
+## unionbounds()
+## Widen bounds, a (minlat, minlon, maxlat, maxlon) tuple or None, to take
+## in every segment of a file's extents (see fileextents())
+##
+def unionbounds(bounds, extents):
+  for trackextents in extents:
+    for segmentbounds in trackextents:
+      if segmentbounds is None:
+        continue
+      if bounds is not None:
+        segmentbounds = (min(segmentbounds[0], bounds[0]), min(segmentbounds[1], bounds[1]),
+                         max(segmentbounds[2], bounds[2]), max(segmentbounds[3], bounds[3]))
+      bounds = tuple(segmentbounds)
+  return bounds
+
+
+##
+## TrackCache
+## Keeps the packed points of each file in a directory so later runs don't
+## have to parse the XML again.  Entries are named after a hash of the
+## file's path and are thrown away when the file's size or modification time
+## changes.  Each entry holds the file's detail pyramid (see detailpyramid())
+## so a view only reads the level it is drawn from.  An entry is a header,
+## the file's path, the [name, type, start] of each track as JSON, a table
+## giving the offset and number of coordinates of each level, and then for
+## each level the segment lengths as int64s followed by the coordinates as
+## float64s.  Levels that are the same as the level below share its data.
+## Everything is little-endian and 8-byte aligned, so the arrays can be read
+## (or memory-mapped) straight out of the file.  Reading an entry updates its
+## modification time, which trim() uses to remove the least recently used
+## entries once the cache is over 'limit' bytes
+##
+class TrackCache(object):
+  MAGIC = b"GPX2PSC3"
+  HEADER = struct.Struct("<8sqdqqqq")  # magic, size, mtime, path length, tracks length, number of lengths, number of levels
+
+  def __init__(self, directory, limit):
+    self.directory = directory
+    self.limit = limit
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as detail:
+        raise Gpx2psError(str(detail))
+
+  def entryname(self, inputfile):
+    path = os.path.abspath(inputfile)
+    return os.path.join(self.directory, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".gpxcache")
+
+  def get(self, inputfile, detail=0):
+    # Returns (packed, tracks), with packed at the given level of detail, or
+    # None if the file isn't cached
+    entry = self.entryname(inputfile)
+    try:
+      stat = inputstat(inputfile)
+      with open(entry, "rb") as infile:
+        total = os.fstat(infile.fileno()).st_size
+        header = infile.read(self.HEADER.size)
+        try:
+          magic, size, mtime, pathlength, trackslength, nlengths, nlevels = self.HEADER.unpack(header)
+          if (magic != self.MAGIC or size != stat.st_size or mtime != stat.st_mtime or
+              pathlength < 0 or trackslength < 0 or nlengths < 0 or nlevels < 1):
+            raise ValueError("stale cache entry")
+          pathsize = pathlength + (-pathlength % 8)
+          trackssize = trackslength + (-trackslength % 8)
+          if self.HEADER.size + pathsize + trackssize + 16*nlevels > total:
+            raise ValueError("stale cache entry")
+          data = infile.read(pathsize + trackssize + 16*nlevels)
+          path = data[:pathlength].decode("utf-8")
+          if path != os.path.abspath(inputfile) or len(data) != pathsize + trackssize + 16*nlevels:
+            raise ValueError("stale cache entry")
+          tracks = json.loads(data[pathsize:pathsize + trackslength].decode("utf-8"))
+          table = array.array('q')
+          table.frombytes(data[pathsize + trackssize:])
+          if sys.byteorder != "little":
+            table.byteswap()
+          if max(table[i] + 8*(nlengths + table[i + 1]) for i in range(0, len(table), 2)) != total:
+            raise ValueError("stale cache entry")
+          level = min(detail, nlevels - 1)
+          offset, ncoords = table[2*level], table[2*level + 1]
+          infile.seek(offset)
+          data = infile.read(8*(nlengths + ncoords))
+          if len(data) != 8*(nlengths + ncoords):
+            raise ValueError("stale cache entry")
+        except (struct.error, ValueError, UnicodeDecodeError):
+          infile.close()
+          self.remove(entry)
+          return None
+    except (IOError, OSError):
+      return None
+
+    flat = array.array('q')
+    flat.frombytes(data[:8*nlengths])
+    coords = array.array('d')
+    coords.frombytes(data[8*nlengths:])
+    if sys.byteorder != "little":
+      flat.byteswap()
+      coords.byteswap()
+
+    # The lengths are stored as the number of segments in a track followed by
+    # the length of each of them
+    lengths = []
+    i = 0
+    while i < len(flat):
+      lengths.append(flat[i + 1:i + 1 + flat[i]].tolist())
+      i += 1 + flat[i]
+
+    try:
+      os.utime(entry, None)
+    except OSError:
+      pass
+    return ((lengths, coords), tracks)
+
+  def put(self, inputfile, pyramid, tracks):
+    # pyramid is every level of the file's detail pyramid, starting with
+    # every point
+    path = os.path.abspath(inputfile).encode("utf-8")
+    tracks = json.dumps(tracks).encode("utf-8")
+    offset = self.HEADER.size + len(path) + (-len(path) % 8) + len(tracks) + (-len(tracks) % 8) + 16*len(pyramid)
+    table = array.array('q')
+    levels = []
+    for level, packed in enumerate(pyramid):
+      if level > 0 and packed is pyramid[level - 1]:
+        table.extend(table[-2:])
+        continue
+      lengths, coords = packed
+      flat = array.array('q')
+      for segmentlengths in lengths:
+        flat.append(len(segmentlengths))
+        flat.extend(segmentlengths)
+      coords = array.array('d', coords)
+      if sys.byteorder != "little":
+        flat.byteswap()
+        coords.byteswap()
+      table.append(offset)
+      table.append(len(coords))
+      levels.append((flat, coords))
+      offset += 8*(len(flat) + len(coords))
+    if sys.byteorder != "little":
+      table.byteswap()
+
+    try:
+      stat = inputstat(inputfile)
+      entry = self.entryname(inputfile)
+      # Write to a temporary file first so that other processes never see
+      # half of an entry
+      fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+      with os.fdopen(fd, "wb") as outfile:
+        outfile.write(self.HEADER.pack(self.MAGIC, stat.st_size, stat.st_mtime,
+                                       len(path), len(tracks), len(levels[0][0]), len(pyramid)))
+        outfile.write(path + b"\0" * (-len(path) % 8))
+        outfile.write(tracks + b" " * (-len(tracks) % 8))
+        outfile.write(table.tobytes())
+        for flat, coords in levels:
+          outfile.write(flat.tobytes())
+          outfile.write(coords.tobytes())
+      os.rename(tmpname, entry)
+    except (IOError, OSError) as detail:
+      warn("Could not write cache entry for %s: %s" % (inputfile, detail))
+
+  def remove(self, entry):
+    try:
+      os.remove(entry)
+    except OSError:
+      pass
+
+  def trim(self):
+    # Remove least recently used entries until the cache fits in its limit
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      if not name.endswith(".gpxcache"):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+      total += stat.st_size
+
+    entries.sort()
+    for mtime, size, name in entries:
+      if total <= self.limit:
+        break
+      self.remove(os.path.join(self.directory, name))
+      total -= size
+
+
+##
+## TrackIndex
+## Remembers the extents of every segment of every file in an input
+## directory, and the [name, type, start] of every track (see GpxReader), in
+## a JSON file kept in that directory.  Entries are keyed by the file's path
+## relative to the directory and are only used while the file's size and
+## modification time still match.  Either the extents or the tracks can be
+## missing from an entry until they are found
+##
+class TrackIndex(object):
+  FILENAME = ".gpx2ps-index"
+
+  def __init__(self, inputdir):
+    self.inputdir = inputdir
+    self.filename = os.path.join(inputdir, self.FILENAME)
+    self.entries = {}    # name -> [size, mtime, extents, tracks]
+    self.changed = False
+    try:
+      with open(self.filename) as infile:
+        index = json.load(infile)
+      if index.get("version") == 1:
+        self.entries = index["files"]
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+      pass
+
+  def name(self, inputfile):
+    return os.path.relpath(inputfile, self.inputdir)
+
+  def lookup(self, inputfile):
+    # Returns the file's extents, or None if they aren't known or are stale
+    entry = self.current(inputfile)
+    if entry is None:
+      return None
+    return entry[2]
+
+  def lookuptracks(self, inputfile):
+    # Returns the file's tracks, or None if they aren't known or are stale
+    entry = self.current(inputfile)
+    if entry is None or len(entry) < 4:
+      return None
+    return entry[3]
+
+  def current(self, inputfile):
+    entry = self.entries.get(self.name(inputfile))
+    if entry is None:
+      return None
+    try:
+      stat = inputstat(inputfile)
+    except OSError:
+      return None
+    if entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+      return None
+    return entry
+
+  def update(self, inputfile, extents=None, tracks=None):
+    name = self.name(inputfile)
+    entry = self.entries.get(name)
+    try:
+      stat = inputstat(inputfile)
+    except OSError:
+      return
+    if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+      entry = self.entries[name] = [stat.st_size, stat.st_mtime, None, None]
+      self.changed = True
+    if len(entry) < 4:
+      entry.append(None)
+    if extents is not None and entry[2] is None:
+      entry[2] = extents
+      self.changed = True
+    if tracks is not None and entry[3] is None:
+      entry[3] = tracks
+      self.changed = True
+
+  def save(self, inputfiles):
+    # Write the index back out, forgetting about files that have gone away
+    names = set(self.name(inputfile) for inputfile in inputfiles)
+    for name in list(self.entries):
+      if name not in names:
+        del self.entries[name]
+        self.changed = True
+    if not self.changed:
+      return
+
+    try:
+      fd, tmpname = tempfile.mkstemp(dir=self.inputdir, prefix=".tmp")
+      with os.fdopen(fd, "w") as outfile:
+        json.dump({"version": 1, "files": self.entries}, outfile)
+      os.rename(tmpname, self.filename)
+    except (IOError, OSError) as detail:
+      warn("Could not write index %s: %s" % (self.filename, detail))
+
+
+##
+## indexextents()
+## The extents an index holds for a file, or None if there is no index
+##
+def indexextents(index, inputfile):
+  if index is None:
+    return None
+  return index.lookup(inputfile)
+
+
+##
+## View
+## Everything needed to decide whether a point is on the map and where it
+## lands on the page.  precision is the number of decimal places to write
+## coordinates with in --compact mode, or None for the usual output.
+## simplify is a tolerance from parsetolerance(), or None.  detail is the
+## level of detail (see detailpyramid()) the files are drawn from, which is
+## 0, every point, with fulldetail.  dedup is the --dedup tolerance, also
+## from parsetolerance(); coverage is then the Coverage of everything drawn
+## with the view so far.  With pdf, lines are drawn with PDF operators
+## instead of postscript ones.  fgrgb and bgrgb are the foreground and
+## background colors, from rgbhextofloat()
+##
+class View(object):
+  def __init__(self, projection, centerlat, centerlon, minlat, minlon, maxlat, maxlon,
+               margin, papersize, xtiles, ytiles, keeppercent, precision=None, simplify=None, clip=False,
+               raster=None, fulldetail=False, dedup=None, pdf=False, fgrgb=(0.0, 0.0, 0.0),
+               bgrgb=(1.0, 1.0, 1.0)):
+    self.projection = projection
+    self.centerlat = centerlat
+    self.centerlon = centerlon
+    self.minlat = minlat
+    self.minlon = minlon
+    self.maxlat = maxlat
+    self.maxlon = maxlon
+    self.margin = margin
+    self.papersize = papersize
+    self.xtiles = xtiles
+    self.ytiles = ytiles
+    self.keeppercent = keeppercent
+    self.precision = precision
+    self.simplify = simplify
+    self.clip = clip
+    self.raster = raster
+    self.pdf = pdf
+    self.fgrgb = fgrgb
+    self.bgrgb = bgrgb
+    if raster is not None:
+      # The size of the --raster grid covering the page
+      self.rastersize = (int(round(papersize[1] * raster / 72.0)), int(round(papersize[0] * raster / 72.0)))
+    self.databounds = None    # what the view was autofitted to, if it was
+    self.pagetiles = xtiles * ytiles    # how many tiles go on a page
+    self.pages = 1
+
+    # Project the minimum and maximum latitude and longitude values onto a
+    # cartesian grid
+    self.minx, self.miny = projection.project(centerlat, centerlon, minlat, minlon)
+    self.maxx, self.maxy = projection.project(centerlat, centerlon, maxlat, maxlon)
+
+    # The simplification tolerance in points on the page, and how close
+    # together points can be before they are thinned out
+    self.tolerance = self.pagedistance(simplify)
+    self.resolution = 0
+
+    self.dedup = dedup
+    if self.pagedistance(dedup) > 0:
+      self.coverage = Coverage(self.pagedistance(dedup), papersize)
+    else:
+      self.coverage = None
+
+    self.fulldetail = fulldetail
+    if fulldetail:
+      self.detail = 0
+    else:
+      self.detail = detaillevel(self)
+
+  def pagedistance(self, tolerance):
+    # A tolerance from parsetolerance() in points on the page, or 0 for None
+    if tolerance is None:
+      return 0
+    amount, units = tolerance
+    if units != "km":
+      return amount
+    height = float(self.papersize[0])/self.ytiles - 2*self.margin
+    latdist = haversine(self.maxlat, self.centerlon, self.minlat, self.centerlon)
+    if latdist > 0:
+      return amount * height / latdist
+    return 0
+
+  def place(self, x, y, xoffset, yoffset):
+    # Scale a projected point to its position on the page
+    papersize = self.papersize
+    return (scale(x,
+                  (self.minx, self.maxx),
+                  (0 + self.margin, papersize[1]/self.xtiles - self.margin)) + xoffset*(papersize[1]/self.xtiles),
+            scale(y,
+                  (self.miny, self.maxy),
+                  (0 + self.margin, papersize[0]/self.ytiles - self.margin)) - yoffset*(papersize[0]/self.ytiles))
+
+
+##
+## drawsegment()
+## Append the postscript for one segment to the list out
+##
+def drawsegment(segment, view, xoffset, yoffset, out):
+  if len(segment) < 2:
+    return
+
+  if view.raster is not None:
+    rastersegment(segment, view, xoffset, yoffset, out)
+    return
+
+  if view.clip:
+    drawclipped(segment, view, xoffset, yoffset, out)
+    return
+
+  with STATS.stage("clip"):
+    inside = insidebox(segment, view)
+  if STATS.enabled:
+    STATS.count("outside", len(inside) - sum(inside))
+  if not any(inside[1:]):
+    # Nothing gets drawn unless at least one point after the first is on the map
+    return
+  with STATS.stage("project"):
+    xs, ys = projectsegment(segment, view, xoffset, yoffset)
+
+  with STATS.stage("format"):
+    drawruns(segment, inside, xs, ys, view, out)
+
+
+##
+## drawruns()
+## The second half of drawsegment(): given which points are inside the
+## bounding box and where they land on the page, write them out
+##
+def drawruns(segment, inside, xs, ys, view, out):
+  # Work out which points get drawn.  They come in runs, each of which is a
+  # moveto to the point before the first one in the bounding box followed by
+  # a lineto for every point up to and including the first one out of it
+  runs = []
+  run = None
+  totaldrawn = 0.0
+  totalseen = 0.0
+  for i in range(1, len(segment)):
+    totalseen += 1
+    if totaldrawn / totalseen > view.keeppercent/100.0:
+      continue
+    totaldrawn += 1
+    if inside[i]:
+      if run is None:
+        run = [i-1]
+        runs.append(run)
+      run.append(i)
+    elif run is not None:
+      run.append(i)
+      run = None
+
+  STATS.count("dropped", len(segment) - 1 - int(totaldrawn))
+  if len(runs) == 0:
+    return
+
+  emitruns(runs, xs, ys, view, out)
+
+
+##
+## emitruns()
+## Simplify runs of points, given as lists of indices into xs and ys, leave
+## out what has already been drawn with --dedup, and write them out.  A run
+## can start at the point the run before it ended at, which is only counted
+## as written once
+##
+def emitruns(runs, xs, ys, view, out):
+  if view.tolerance > 0 or view.resolution > 0:
+    with STATS.stage("simplify"):
+      before = sum(len(run) for run in runs)
+      if view.resolution > 0:
+        runs = [thinrun(run, xs, ys, view.resolution) for run in runs]
+      if view.tolerance > 0:
+        runs = [simplifyrun(run, xs, ys, view.tolerance) for run in runs]
+      STATS.count("simplified", before - sum(len(run) for run in runs))
+
+  if view.coverage is not None:
+    with STATS.stage("dedup"):
+      before = sum(len(run) for run in runs)
+      runs = view.coverage.uncovered(runs, xs, ys)
+      STATS.count("deduped", before - sum(len(run) for run in runs))
+    if len(runs) == 0:
+      return
+
+  if STATS.enabled:
+    shared = sum(1 for before, run in zip(runs, runs[1:]) if before[-1] == run[0])
+    STATS.count("emitted", -shared)
+
+  if view.precision is not None:
+    if not view.pdf:
+      out.append("n\n")
+    for run in runs:
+      text = compactrun(run, xs, ys, view.precision, view.pdf)
+      STATS.count("emitted", text.count("\n"))    # points that round to the one before aren't written
+      out.append(text)
+    out.append("S\n" if view.pdf else "s\n")
+    return
+
+  # Format each run with a single string operation
+  if view.pdf:
+    moveto, lineto, stroke = "%f %f m\n", "%f %f l\n", "S\n"
+  else:
+    moveto, lineto, stroke = "%f %f moveto\n", "%f %f lineto\n", "stroke\n"
+    out.append("newpath\n")
+  for run in runs:
+    coords = []
+    for i in run:
+      coords.append(xs[i])
+      coords.append(ys[i])
+    out.append((moveto + lineto * (len(run) - 1)) % tuple(coords))
+    STATS.count("emitted", len(run))
+  out.append(stroke)
+
+
+##
+## drawclipped()
+## drawsegment() for --clip.  Lines are cut off exactly where they cross the
+## edge of the map.  Cohen-Sutherland outcodes throw away the lines that
+## can't cross it before anything is projected, and what is left is clipped
+## with liangbarsky() in page coordinates.  With a cylindrical projection
+## the outcodes come straight from the latitudes and longitudes, so only the
+## points at the ends of lines that might be on the map are projected
+##
+def drawclipped(segment, view, xoffset, yoffset, out):
+  kept = keptpoints(len(segment), view.keeppercent)
+  STATS.count("dropped", len(segment) - len(kept))
+
+  xmin, ymin = view.place(view.minx, view.miny, xoffset, yoffset)
+  xmax, ymax = view.place(view.maxx, view.maxy, xoffset, yoffset)
+
+  if view.projection.cylindrical:
+    with STATS.stage("clip"):
+      codes = latloncodes(segment, view)
+      lines = [(a, b) for a, b in zip(kept, kept[1:]) if not codes[a] & codes[b]]
+    if STATS.enabled:
+      STATS.count("outside", len(codes) - codes.count(0))
+    if len(lines) == 0:
+      return
+    with STATS.stage("project"):
+      needed = sorted(set([a for a, b in lines] + [b for a, b in lines]))
+      pxs, pys = projectsegment(segment.take(needed), view, xoffset, yoffset)
+      xs = [0.0] * len(segment)
+      ys = [0.0] * len(segment)
+      for i, x, y in zip(needed, pxs, pys):
+        xs[i] = x
+        ys[i] = y
+  else:
+    with STATS.stage("project"):
+      xs, ys = projectsegment(segment, view, xoffset, yoffset)
+    with STATS.stage("clip"):
+      codes = outcodes(xs, ys, xmin, ymin, xmax, ymax)
+      lines = [(a, b) for a, b in zip(kept, kept[1:]) if not codes[a] & codes[b]]
+    if STATS.enabled:
+      STATS.count("outside", len(codes) - codes.count(0))
+
+  # Join the clipped lines back up into runs of points
+  with STATS.stage("clip"):
+    cxs = []
+    cys = []
+    runs = []
+    run = None
+    last = None
+    for a, b in lines:
+      if codes[a] == 0 and codes[b] == 0:
+        t0, t1 = 0.0, 1.0
+      else:
+        clipped = liangbarsky(xs[a], ys[a], xs[b], ys[b], xmin, ymin, xmax, ymax)
+        if clipped is None:
+          run = None
+          continue
+        t0, t1 = clipped
+      if run is None or t0 > 0 or last != a:
+        run = []
+        runs.append(run)
+        run.append(len(cxs))
+        cxs.append(xs[a] + t0 * (xs[b] - xs[a]))
+        cys.append(ys[a] + t0 * (ys[b] - ys[a]))
+      run.append(len(cxs))
+      cxs.append(xs[a] + t1 * (xs[b] - xs[a]))
+      cys.append(ys[a] + t1 * (ys[b] - ys[a]))
+      if t1 < 1:
+        run = None
+      last = b
+
+  if len(runs) > 0:
+    with STATS.stage("format"):
+      emitruns(runs, cxs, cys, view, out)
+
+##
+## keptpoints()
+## The indices of the points of an n point segment that are kept after
+## --droppercent, dropped the same way drawruns() drops them
+##
+def keptpoints(n, keeppercent):
+  kept = [0]
+  totaldrawn = 0.0
+  totalseen = 0.0
+  for i in range(1, n):
+    totalseen += 1
+    if totaldrawn / totalseen > keeppercent/100.0:
+      continue
+    totaldrawn += 1
+    kept.append(i)
+  return kept
+
+def latloncodes(segment, view):
+  minlat, minlon, maxlat, maxlon = view.minlat, view.minlon, view.maxlat, view.maxlon
+  return [(1 if lon < minlon else 2 if lon > maxlon else 0) |
+          (4 if lat < minlat else 8 if lat > maxlat else 0) for lat, lon in zip(segment.lats, segment.lons)]
+
+def outcodes(xs, ys, xmin, ymin, xmax, ymax):
+  return [(1 if x < xmin else 2 if x > xmax else 0) |
+          (4 if y < ymin else 8 if y > ymax else 0) for x, y in zip(xs, ys)]
+
+
+##
+## liangbarsky()
+## Clip the line from (x0, y0) to (x1, y1) to a rectangle.  Returns the
+## parameters (t0, t1) of the part of the line inside it, where 0 is the
+## start of the line and 1 the end, or None if none of it is
+##
+def liangbarsky(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+  t0 = 0.0
+  t1 = 1.0
+  dx = x1 - x0
+  dy = y1 - y0
+  for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+    if p == 0:
+      if q < 0:
+        return None
+    else:
+      t = q / p
+      if p < 0:
+        if t > t1:
+          return None
+        if t > t0:
+          t0 = t
+      else:
+        if t < t0:
+          return None
+        if t < t1:
+          t1 = t
+  return (t0, t1)
+
+##
+## pageline()
+## The part of a line that is within 0 to width and 0 to height, or None if
+## none of it is
+##
+def pageline(x0, y0, x1, y1, width, height):
+  if 0 <= x0 <= width and 0 <= y0 <= height and 0 <= x1 <= width and 0 <= y1 <= height:
+    return (x0, y0, x1, y1)
+  clipped = liangbarsky(x0, y0, x1, y1, 0, 0, width, height)
+  if clipped is None:
+    return None
+  t0, t1 = clipped
+  return (x0 + t0 * (x1 - x0), y0 + t0 * (y1 - y0), x0 + t1 * (x1 - x0), y0 + t1 * (y1 - y0))
+
+
+##
+## rastersegment()
+## drawsegment() for --raster: find every cell of the density grid that the
+## lines of the segment pass through, and append them to out as an array of
+## cell numbers.  Each cell is only listed once per segment, so the grid
+## ends up counting how many times a cell was travelled through rather than
+## how many points were recorded in it.  Lines are cut down to the part of
+## them on the grid (see pageline()) and then sampled at least once per
+## cell, all at once with numpy when it is available, so a point far off the
+## map doesn't cost a sample for every cell on the way to it
+##
+def rastersegment(segment, view, xoffset, yoffset, out):
+  kept = keptpoints(len(segment), view.keeppercent)
+  STATS.count("dropped", len(segment) - len(kept))
+  if len(kept) < len(segment):
+    segment = segment.take(kept)
+
+  with STATS.stage("project"):
+    xs, ys = projectsegment(segment, view, xoffset, yoffset)
+
+  width, height = view.rastersize
+  xscale = float(width) / view.papersize[1]
+  yscale = float(height) / view.papersize[0]
+
+  with STATS.stage("raster"):
+    if numpy is not None:
+      # Cell coordinates, with rows counting down from the top of the page
+      px = numpy.array(xs, dtype=float) * xscale
+      py = height - numpy.array(ys, dtype=float) * yscale
+      if len(px) == 1:
+        # A single point is drawn as a line that goes nowhere
+        px = numpy.repeat(px, 2)
+        py = numpy.repeat(py, 2)
+      x0, y0, x1, y1 = px[:-1].copy(), py[:-1].copy(), px[1:].copy(), py[1:].copy()
+      onpage = ((x0 >= 0) & (x0 <= width) & (y0 >= 0) & (y0 <= height) &
+                (x1 >= 0) & (x1 <= width) & (y1 >= 0) & (y1 <= height))
+      for i in numpy.flatnonzero(~onpage).tolist():
+        end = pageline(float(x0[i]), float(y0[i]), float(x1[i]), float(y1[i]), width, height)
+        if end is not None:
+          x0[i], y0[i], x1[i], y1[i] = end
+          onpage[i] = True
+      lines = numpy.flatnonzero(onpage)
+      x0, y0, x1, y1 = x0[lines], y0[lines], x1[lines], y1[lines]
+      dx = x1 - x0
+      dy = y1 - y0
+      steps = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(dx), numpy.abs(dy))), 1).astype(int)
+      counts = steps + 1
+      starts = numpy.cumsum(counts) - counts
+      sample = numpy.repeat(numpy.arange(len(steps)), counts)
+      t = (numpy.arange(len(sample)) - starts[sample]) / steps[sample].astype(float)
+      cols = numpy.floor(x0[sample] + t * dx[sample]).astype(int)
+      rows = numpy.floor(y0[sample] + t * dy[sample]).astype(int)
+      onmap = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+      cells = numpy.unique(rows[onmap] * width + cols[onmap])
+    else:
+      px = [x * xscale for x in xs]
+      py = [height - y * yscale for y in ys]
+      if len(px) == 1:
+        px = px * 2
+        py = py * 2
+      cellset = set()
+      for i in range(1, len(px)):
+        end = pageline(px[i-1], py[i-1], px[i], py[i], width, height)
+        if end is None:
+          continue
+        x0, y0, x1, y1 = end
+        dx = x1 - x0
+        dy = y1 - y0
+        steps = max(int(math.ceil(max(abs(dx), abs(dy)))), 1)
+        for step in range(steps + 1):
+          t = step / float(steps)
+          col = int(math.floor(x0 + t * dx))
+          row = int(math.floor(y0 + t * dy))
+          if col >= 0 and col < width and row >= 0 and row < height:
+            cellset.add(row * width + col)
+      cells = array.array('l', sorted(cellset))
+
+  if STATS.enabled:
+    STATS.count("outside", sum(1 for x, y in zip(xs, ys)
+                               if not (0 <= x * xscale < width and 0 <= height - y * yscale < height)))
+  if len(cells) > 0:
+    out.append(cells)
+
+
+##
+## joinout()
+## Join up what drawsegment() appended to out: postscript text, or arrays of
+## density grid cells in --raster mode
+##
+def joinout(out, view):
+  if view.raster is None:
+    return "".join(out)
+  if numpy is not None:
+    return numpy.concatenate(out) if len(out) > 0 else numpy.zeros(0, dtype=int)
+  cells = array.array('l')
+  for segmentcells in out:
+    cells.extend(segmentcells)
+  return cells
+
+
+##
+## DensityGrid
+## Counts how many times each cell of a --raster grid has been travelled
+## through.  It takes the place of the PostScriptWriter while the files are
+## drawn, taking the arrays of cells drawfile() returns, and is then written
+## out as a single image.  With numpy the counting is done in batches with
+## bincount(), and the image is worked out RASTERBLOCK cells at a time
+##
+RASTERBLOCK = 1 << 20
+
+class DensityGrid(object):
+  def __init__(self, view):
+    self.width, self.height = view.rastersize
+    if numpy is not None:
+      self.counts = numpy.zeros(self.width * self.height, dtype=numpy.int64)
+    else:
+      self.counts = array.array('l', [0]) * (self.width * self.height)
+    self.pending = []
+    self.npending = 0
+
+  def write(self, cells):
+    if numpy is None:
+      counts = self.counts
+      for cell in cells:
+        counts[cell] += 1
+      return
+    self.pending.append(cells)
+    self.npending += len(cells)
+    if self.npending >= len(self.counts):
+      self.flush()
+
+  def flush(self):
+    if len(self.pending) > 0:
+      self.counts += numpy.bincount(numpy.concatenate(self.pending), minlength=len(self.counts))
+      self.pending = []
+      self.npending = 0
+
+  def emit(self, writer, args, view):
+    # Write the grid as an image covering the page, shaded from the
+    # background color for no tracks up to the foreground color for the
+    # most travelled cell
+    fgrgb = view.fgrgb
+    bgrgb = view.bgrgb
+    with STATS.stage("raster"):
+      if numpy is not None:
+        self.flush()
+        peak = max(float(self.counts.max()), 1.0)
+        pixels = numpy.empty((len(self.counts), 3), dtype=numpy.uint8)
+        # A block of cells at a time, so that the floating point copies of
+        # a fine grid don't all have to be held at once
+        for first in range(0, len(self.counts), RASTERBLOCK):
+          counts = self.counts[first:first + RASTERBLOCK].astype(float)
+          if args.ramp == "log":
+            levels = numpy.log1p(counts) / math.log1p(peak)
+          else:
+            levels = counts / peak
+          for channel in range(3):
+            pixels[first:first + RASTERBLOCK, channel] = numpy.rint(
+              255 * (bgrgb[channel] + levels * (fgrgb[channel] - bgrgb[channel])))
+        data = pixels.tobytes()
+      else:
+        peak = max(max(self.counts), 1)
+        ramp = {}
+        pixels = bytearray()
+        for count in self.counts:
+          if count not in ramp:
+            if args.ramp == "log":
+              level = math.log1p(count) / math.log1p(peak)
+            else:
+              level = float(count) / peak
+            ramp[count] = bytearray(int(round(255 * (bgrgb[channel] + level * (fgrgb[channel] - bgrgb[channel]))))
+                                    for channel in range(3))
+          pixels += ramp[count]
+        data = bytes(pixels)
+    writer.image(self.width, self.height, data, view.papersize)
+
+
+##
+## simplifyrun()
+## Douglas-Peucker simplification of a run of points: returns the indices of
+## the points needed to keep the line within tolerance points of where it
+## was.  The first and last points are always kept.  Uses numpy for the
+## distance calculations when it is available
+##
+def simplifyrun(run, xs, ys, tolerance):
+  if len(run) < 3:
+    return run
+
+  if numpy is not None:
+    rx = numpy.array([xs[i] for i in run])
+    ry = numpy.array([ys[i] for i in run])
+    farthest = farthestpointbatch
+  else:
+    rx = [xs[i] for i in run]
+    ry = [ys[i] for i in run]
+    farthest = farthestpoint
+
+  keep = [False] * len(run)
+  keep[0] = True
+  keep[-1] = True
+  stack = [(0, len(run) - 1)]
+  while stack:
+    first, last = stack.pop()
+    if last - first < 2:
+      continue
+    index, distance = farthest(rx, ry, first, last)
+    if distance > tolerance * tolerance:
+      keep[index] = True
+      stack.append((first, index))
+      stack.append((index, last))
+
+  return [i for i, kept in zip(run, keep) if kept]
+
+
+##
+## thinrun()
+## Drop the points of a run that are closer than resolution to the last
+## point kept, which can't be told apart on the page anyway.  Unlike
+## simplifyrun() this is a single pass.  The first and last points are
+## always kept
+##
+def thinrun(run, xs, ys, resolution):
+  if len(run) < 3:
+    return run
+
+  limit = resolution * resolution
+  kept = [run[0]]
+  lastx = xs[run[0]]
+  lasty = ys[run[0]]
+  for i in run[1:-1]:
+    dx = xs[i] - lastx
+    dy = ys[i] - lasty
+    if dx*dx + dy*dy >= limit:
+      kept.append(i)
+      lastx = xs[i]
+      lasty = ys[i]
+  kept.append(run[-1])
+  return kept
+
+
+##
+## farthestpoint()
+## Find which of the points strictly between first and last is farthest from
+## the line between them, returning its index and squared distance
+##
+def farthestpoint(xs, ys, first, last):
+  x0, y0 = xs[first], ys[first]
+  dx = xs[last] - x0
+  dy = ys[last] - y0
+  length = dx*dx + dy*dy
+
+  best = first + 1
+  bestdistance = -1.0
+  for i in range(first + 1, last):
+    px = xs[i] - x0
+    py = ys[i] - y0
+    if length > 0:
+      t = min(max((px*dx + py*dy) / length, 0.0), 1.0)
+      px -= t*dx
+      py -= t*dy
+    distance = px*px + py*py
+    if distance > bestdistance:
+      best = i
+      bestdistance = distance
+  return (best, bestdistance)
+
+def farthestpointbatch(xs, ys, first, last):
+  x0, y0 = xs[first], ys[first]
+  dx = xs[last] - x0
+  dy = ys[last] - y0
+  length = dx*dx + dy*dy
+
+  px = xs[first + 1:last] - x0
+  py = ys[first + 1:last] - y0
+  if length > 0:
+    t = numpy.clip((px*dx + py*dy) / length, 0.0, 1.0)
+    px = px - t*dx
+    py = py - t*dy
+  distances = px*px + py*py
+  i = int(numpy.argmax(distances))
+  return (first + 1 + i, float(distances[i]))
+
+
+##
+## Coverage
+## For --dedup: the cells of a grid over the page that lines have been drawn
+## through.  Cells are tolerance/sqrt(2) points across, so everywhere in a
+## covered cell is within tolerance of a line already drawn, and a line whose
+## cells are all covered can be left out without the page changing by more
+## than that.  Lines are sampled at least once per cell, like
+## rastersegment() does, and only on the page.  Cells are numbered column *
+## COVERAGEROWS + row and kept in a set, so repeated tracks cost one hash
+## lookup per cell, however many times they are drawn
+##
+COVERAGEROWS = 1 << 32
+
+class Coverage(object):
+  def __init__(self, tolerance, papersize):
+    self.cellsize = tolerance / math.sqrt(2)
+    self.width = float(papersize[1])
+    self.height = float(papersize[0])
+    self.cells = set()
+
+  def uncovered(self, runs, xs, ys):
+    # The parts of runs, lists of indices into xs and ys, whose lines aren't
+    # all covered, as runs.  These are then covered too, but only once the
+    # whole list has been gone through, so a track never covers itself
+    nlines = sum(len(run) - 1 for run in runs)
+    if nlines == 0:
+      return runs
+    cells, line = self.linecells(runs, xs, ys)
+    covered = self.cells
+    if numpy is not None:
+      missing = numpy.array([cell not in covered for cell in cells.tolist()], dtype=bool)
+      keep = numpy.bincount(line[missing], minlength=nlines) > 0
+      covered.update(cells[keep[line]].tolist())
+      keep = keep.tolist()
+    else:
+      keep = [False] * nlines
+      for cell, i in zip(cells, line):
+        if not keep[i] and cell not in covered:
+          keep[i] = True
+      covered.update([cell for cell, i in zip(cells, line) if keep[i]])
+
+    kept = []
+    i = 0
+    for run in runs:
+      piece = None
+      for a, b in zip(run, run[1:]):
+        if keep[i]:
+          if piece is None:
+            piece = [a]
+            kept.append(piece)
+          piece.append(b)
+        else:
+          piece = None
+        i += 1
+    return kept
+
+  def linecells(self, runs, xs, ys):
+    # The cells each line of the runs passes through, as (cells, line) where
+    # line[i] is the number of the line that cells[i] was found on, counting
+    # through the runs in order
+    cellsize = self.cellsize
+    if numpy is not None:
+      first = numpy.concatenate([run[:-1] for run in runs]).astype(int)
+      last = numpy.concatenate([run[1:] for run in runs]).astype(int)
+      px = numpy.array(xs, dtype=float)
+      py = numpy.array(ys, dtype=float)
+      x0, y0, x1, y1 = px[first], py[first], px[last], py[last]
+      onpage = ((x0 >= 0) & (x0 <= self.width) & (y0 >= 0) & (y0 <= self.height) &
+                (x1 >= 0) & (x1 <= self.width) & (y1 >= 0) & (y1 <= self.height))
+      for i in numpy.flatnonzero(~onpage).tolist():
+        end = pageline(float(x0[i]), float(y0[i]), float(x1[i]), float(y1[i]), self.width, self.height)
+        if end is not None:
+          x0[i], y0[i], x1[i], y1[i] = end
+          onpage[i] = True
+      lines = numpy.flatnonzero(onpage)
+      x0, y0, x1, y1 = x0[lines], y0[lines], x1[lines], y1[lines]
+      dx = x1 - x0
+      dy = y1 - y0
+      steps = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(dx), numpy.abs(dy)) / cellsize), 1).astype(int)
+      counts = steps + 1
+      starts = numpy.cumsum(counts) - counts
+      sample = numpy.repeat(numpy.arange(len(steps)), counts)
+      t = (numpy.arange(len(sample)) - starts[sample]) / steps[sample].astype(float)
+      cols = numpy.floor((x0[sample] + t * dx[sample]) / cellsize).astype(numpy.int64)
+      rows = numpy.floor((y0[sample] + t * dy[sample]) / cellsize).astype(numpy.int64)
+      return (cols * COVERAGEROWS + rows, lines[sample])
+
+    cells = []
+    line = []
+    i = 0
+    for run in runs:
+      for a, b in zip(run, run[1:]):
+        end = pageline(xs[a], ys[a], xs[b], ys[b], self.width, self.height)
+        if end is not None:
+          x0, y0, x1, y1 = end
+          dx = x1 - x0
+          dy = y1 - y0
+          steps = max(int(math.ceil(max(abs(dx), abs(dy)) / cellsize)), 1)
+          for step in range(steps + 1):
+            t = step / float(steps)
+            cells.append(int(math.floor((x0 + t * dx) / cellsize)) * COVERAGEROWS +
+                         int(math.floor((y0 + t * dy) / cellsize)))
+            line.append(i)
+        i += 1
+    return (cells, line)
+
+
+##
+## compactrun()
+## Format a run of points for --compact mode: an absolute moveto followed by
+## relative linetos, with coordinates rounded to the given number of decimal
+## places.  Deltas are taken between rounded positions so they never drift,
+## and points that round to the same position as the one before are dropped.
+## PDF has no relative lineto, so with pdf the linetos are absolute too
+##
+COMPACTPROLOG = """/n {newpath} bind def
+/m {moveto} bind def
+/l {rlineto} bind def
+/s {stroke} bind def
+"""
+
+def compactrun(run, xs, ys, precision, pdf=False):
+  factor = 10 ** precision
+  px = int(round(xs[run[0]] * factor))
+  py = int(round(ys[run[0]] * factor))
+  parts = ["%s %s m\n" % (fixed(px, precision), fixed(py, precision))]
+  for i in run[1:]:
+    x = int(round(xs[i] * factor))
+    y = int(round(ys[i] * factor))
+    if x == px and y == py:
+      continue
+    if pdf:
+      parts.append("%s %s l\n" % (fixed(x, precision), fixed(y, precision)))
+    else:
+      parts.append("%s %s l\n" % (fixed(x - px, precision), fixed(y - py, precision)))
+    px = x
+    py = y
+  if len(parts) == 1:
+    # Keep the dot a zero length line makes with round line caps
+    if pdf:
+      parts.append("%s %s l\n" % (fixed(px, precision), fixed(py, precision)))
+    else:
+      parts.append("0 0 l\n")
+  return "".join(parts)
+
+
+##
+## fixed()
+## Format a whole number of 10**-precision units as the shortest decimal
+## that postscript will read back, e.g. 5 units at precision 2 is ".05"
+##
+def fixed(value, precision):
+  if value == 0 or precision == 0:
+    return str(value)
+  if value < 0:
+    sign = "-"
+  else:
+    sign = ""
+  whole, frac = divmod(abs(value), 10 ** precision)
+  if frac == 0:
+    return sign + str(whole)
+  digits = ("%0*d" % (precision, frac)).rstrip("0")
+  if whole == 0:
+    return sign + "." + digits
+  return "%s%d.%s" % (sign, whole, digits)
+
+
+##
+## insidebox()
+## Returns a list saying whether each point of a segment is inside the
+## bounding box of a view
+##
+def insidebox(segment, view):
+  minlat, minlon, maxlat, maxlon = view.minlat, view.minlon, view.maxlat, view.maxlon
+  return [(lat > minlat and lat < maxlat) and (lon > minlon and lon < maxlon)
+          for lat, lon in zip(segment.lats, segment.lons)]
+
+
+##
+## projectsegment()
+## Project every point of a segment and scale it onto the page, returning
+## lists of x and y coordinates.  With numpy the whole segment is done as
+## arrays, giving exactly the same numbers as the per-point functions
+##
+def projectsegment(segment, view, xoffset, yoffset):
+  papersize = view.papersize
+  xdst = (0 + view.margin, papersize[1]/view.xtiles - view.margin)
+  ydst = (0 + view.margin, papersize[0]/view.ytiles - view.margin)
+  xshift = xoffset*(papersize[1]/view.xtiles)
+  yshift = yoffset*(papersize[0]/view.ytiles)
+
+  if numpy is None or view.projection.batchfunc is None:
+    project = view.projection.func
+    xs = []
+    ys = []
+    for lat, lon in zip(segment.lats, segment.lons):
+      x, y = project(view.centerlat, view.centerlon, lat, lon)
+      x, y = view.place(x, y, xoffset, yoffset)
+      xs.append(x)
+      ys.append(y)
+    return (xs, ys)
+
+  lats = numpy.frombuffer(segment.lats, dtype=float)
+  lons = numpy.frombuffer(segment.lons, dtype=float)
+  x, y = view.projection.projectbatch(view.centerlat, view.centerlon, lats, lons)
+
+  # Same order of operations as scale()
+  xs = ((x - float(view.minx)) / (float(view.maxx) - float(view.minx))) * (float(xdst[1]) - float(xdst[0])) + float(xdst[0]) + xshift
+  ys = ((y - float(view.miny)) / (float(view.maxy) - float(view.miny))) * (float(ydst[1]) - float(ydst[0])) + float(ydst[0]) - yshift
+  return (xs.tolist(), ys.tolist())
+
+
+##
+## libm()
+## Apply a function from the math module to every value of an array.  numpy's
+## own versions of tan(), asinh() and friends may use vector code that
+## differs from the C library in the last bit, so the batch projections go
+## through math to match the per-point projections exactly
+##
+def libm(func, values):
+  return numpy.fromiter(map(func, values.tolist()), dtype=float, count=len(values))
+
+
+##
+## Batch versions of the projections, taking and returning numpy arrays
+##
+DEGTORAD = math.pi / 180.0
+
+def equirectangularbatch(centlat, centlon, lat, lon):
+  return (lon, lat)
+
+def millercylindricalbatch(centlat, centlon, lat, lon):
+  l0 = centlon * DEGTORAD
+  p = lat * DEGTORAD
+  l = lon * DEGTORAD
+
+  x = l - l0
+  y = 1.25*libm(math.asinh, libm(math.tan, .8*p))
+
+  return (x, y)
+
+def lambertazimuthalbatch(centlat, centlon, lat, lon):
+  p1 = centlat * DEGTORAD
+  l0 = centlon * DEGTORAD
+  p = lat * DEGTORAD
+  l = lon * DEGTORAD
+  sinp = libm(math.sin, p)
+  cosp = libm(math.cos, p)
+  cosdl = libm(math.cos, l - l0)
+  k = numpy.sqrt(2/(1+math.sin(p1)*sinp + math.cos(p1)*cosp*cosdl))
+
+  x = k * cosp * libm(math.sin, l - l0)
+  y = k * (math.cos(p1)*sinp - math.sin(p1)*cosp*cosdl)
+
+  return (x, y)
+
+
+##
+## Stats
+## Wall clock and CPU time spent in each stage of a run, and counts of
+## files, points and bytes.  Nothing is recorded unless enabled is set.
+## Per file counts are the difference between startfile() and endfile()
+##
+class Stats(object):
+  STAGES = ("parse", "cache", "bounds", "detail", "clip", "project", "simplify", "dedup", "format", "raster", "write")
+  FILECOUNTERS = ("points", "outside", "dropped", "simplified", "deduped", "emitted")
+
+  def __init__(self):
+    self.enabled = False
+    self.clear()
+
+  def clear(self):
+    self.stages = {}     # name -> [wall, cpu, calls]
+    self.counters = {}
+    self.files = {}      # inputfile -> {counter: count}
+    self.wall = None
+    self.cpu = None
+
+  def start(self):
+    self.wall = -time.time()
+    self.cpu = -time.process_time()
+
+  def stop(self):
+    self.wall += time.time()
+    self.cpu += time.process_time()
+
+  def stage(self, name):
+    if not self.enabled:
+      return NOTIMER
+    return StageTimer(self, name)
+
+  def count(self, name, n=1):
+    if self.enabled:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def startfile(self):
+    if not self.enabled:
+      return None
+    return dict(self.counters)
+
+  def endfile(self, inputfile, start):
+    if not self.enabled:
+      return
+    counts = self.files.setdefault(inputfile, {})
+    for name in self.FILECOUNTERS:
+      n = self.counters.get(name, 0) - start.get(name, 0)
+      if n:
+        counts[name] = counts.get(name, 0) + n
+
+  def snapshot(self):
+    return (self.stages, self.counters, self.files)
+
+  def merge(self, snapshot):
+    stages, counters, files = snapshot
+    for name, (wall, cpu, calls) in stages.items():
+      total = self.stages.setdefault(name, [0.0, 0.0, 0])
+      total[0] += wall
+      total[1] += cpu
+      total[2] += calls
+    for name, n in counters.items():
+      self.counters[name] = self.counters.get(name, 0) + n
+    for inputfile, counts in files.items():
+      total = self.files.setdefault(inputfile, {})
+      for name, n in counts.items():
+        total[name] = total.get(name, 0) + n
+
+  def asdict(self):
+    stages = {}
+    for name, (wall, cpu, calls) in self.stages.items():
+      stages[name] = {"wall": wall, "cpu": cpu, "calls": calls}
+    return {"wall": self.wall, "cpu": self.cpu, "stages": stages,
+            "counters": self.counters, "files": self.files}
+
+  def report(self, outfile):
+    outfile.write("%-10s %10s %10s %10s\n" % ("Stage", "Wall (s)", "CPU (s)", "Calls"))
+    names = [name for name in self.STAGES if name in self.stages]
+    names += sorted(name for name in self.stages if name not in self.STAGES)
+    for name in names:
+      wall, cpu, calls = self.stages[name]
+      outfile.write("%-10s %10.3f %10.3f %10d\n" % (name, wall, cpu, calls))
+    outfile.write("%-10s %10.3f %10.3f\n" % ("total", self.wall, self.cpu))
+    counter = lambda name: self.counters.get(name, 0)
+    outfile.write("Files: %d parsed, %d from cache, %d bad, %d skipped as off the map, %d filtered out, %d copied from the previous output\n" %
+                  (counter("parsedfiles"), counter("cachedfiles"), counter("badfiles"), counter("skippedfiles"),
+                   counter("filteredfiles"), counter("reusedfiles")))
+    outfile.write("Tracks: %d read, %d filtered out\n" % (counter("tracks"), counter("filteredtracks")))
+    outfile.write("Points: %d read, %d outside the map, %d dropped, %d simplified away, %d left out as duplicates, %d written\n" %
+                  (counter("points"), counter("outside"), counter("dropped"), counter("simplified"), counter("deduped"),
+                   counter("emitted")))
+    outfile.write("Bytes written: %d\n" % counter("bytes"))
+
+class StageTimer(object):
+  def __init__(self, stats, name):
+    self.stats = stats
+    self.name = name
+
+  def __enter__(self):
+    self.wall = time.time()
+    self.cpu = time.process_time()
+
+  def __exit__(self, *exc):
+    total = self.stats.stages.setdefault(self.name, [0.0, 0.0, 0])
+    total[0] += time.time() - self.wall
+    total[1] += time.process_time() - self.cpu
+    total[2] += 1
+
+class NoTimer(object):
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+NOTIMER = NoTimer()
+STATS = Stats()
+
+
+##
+## warn()
+##
+def warn(message):
+  sys.stderr.write(message + "\n")
+
+
+##
+## scale()
+## Scales a value from tuple src to tuple dst
+##
+def scale(val, src, dst):
+  return ((float(val) - float(src[0])) / (float(src[1])-float(src[0]))) * (float(dst[1])-float(dst[0])) + float(dst[0])
+
+##
+## equirectangular()
+## Performs the equirectangular projection calculation
+##
+def equirectangular(centlat, centlon, lat, lon):
+  return (lon, lat)
+
+
+##
+## millercylindrical()
+## Performs the miller cylindrical projection calculation
+##
+def millercylindrical(centlat, centlon, lat, lon):
   p1, l0, p, l = map(math.radians, [centlat, centlon, lat, lon])
 
   x = l - l0
@@ -531,6 +4152,33 @@ def lambertazimuthal(centlat, centlon, lat, lon):
 
   return (x, y)
 
+
+##
+## Projection
+## A map projection.  func takes (centlat, centlon, lat, lon) in degrees and
+## returns a cartesian (x, y); batchfunc, if there is one, does the same for
+## numpy arrays of latitudes and longitudes.  In a cylindrical projection x
+## depends only on longitude and y only on latitude, both increasing
+##
+class Projection(object):
+  def __init__(self, name, func, batchfunc=None, cylindrical=False):
+    self.name = name
+    self.func = func
+    self.batchfunc = batchfunc
+    self.cylindrical = cylindrical
+
+  def project(self, centlat, centlon, lat, lon):
+    return self.func(centlat, centlon, lat, lon)
+
+  def projectbatch(self, centlat, centlon, lat, lon):
+    return self.batchfunc(centlat, centlon, lat, lon)
+
+PROJECTIONS = {
+  "equirectangular": Projection("equirectangular", equirectangular, equirectangularbatch, True),
+  "millercylindrical": Projection("millercylindrical", millercylindrical, millercylindricalbatch, True),
+  "lambertazimuthal": Projection("lambertazimuthal", lambertazimuthal, lambertazimuthalbatch),
+}
+
 ##
 ## radiuspoint()
 ## Given a point, a radius, and a direction, find the lat/lon of the new point
@@ -562,8 +4210,7 @@ def radiustokm(radiusstring):
   result = re.search("^(\d+\.?\d*)(\w+)$", radiusstring)
 
   if result == None:
-    sys.stderr.write("Error: radius string could not be parsed\n")
-    sys.exit(1)
+    raise Gpx2psError("radius string could not be parsed")
 
   radius = result.group(1)
   units = result.group(2)
@@ -577,8 +4224,59 @@ def radiustokm(radiusstring):
   elif units == "m":
     return .001 * float(radius)
   else:
-    sys.stderr.write("Error: radius units not recognized\n")
-    sys.exit(1)
+    raise Gpx2psError("radius units not recognized")
+
+##
+## parsetolerance()
+## Parse a --simplify or --dedup tolerance: either a number of points,
+## optionally followed by "pt", or a distance in the units radiustokm()
+## understands.  Returns (points, "pt") or (kilometers, "km")
+##
+def parsetolerance(tolerancestring, option="simplify"):
+  result = re.search(r"^(\d+\.?\d*)(pt|mi|ft|km|m)?$", tolerancestring)
+
+  if result == None:
+    raise Gpx2psError("%s tolerance could not be parsed" % option)
+
+  if result.group(2) in (None, "pt"):
+    return (float(result.group(1)), "pt")
+  return (radiustokm(tolerancestring), "km")
+
+##
+## parsetime()
+## Parse an ISO 8601 date, or date and time, as found in GPX <time>
+## elements, into seconds since 1970.  Times without a time zone are taken
+## to be UTC.  Returns None if it can't be parsed
+##
+TIMEFORMAT = re.compile(r"^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d(?:\.\d*)?))?)?(Z|[+-]\d\d:?\d\d)?$")
+
+def parsetime(timestring):
+  result = TIMEFORMAT.search(timestring)
+  if result == None:
+    return None
+  year, month, day, hour, minute, second, zone = result.groups()
+  try:
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour or 0), int(minute or 0), 0))
+  except (ValueError, OverflowError):
+    return None
+  seconds += float(second or 0)
+  if zone not in (None, "Z"):
+    offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+    if zone[0] == "+":
+      seconds -= offset
+    else:
+      seconds += offset
+  return seconds
+
+##
+## parsedate()
+## Parse a --since or --until date with parsetime()
+##
+def parsedate(datestring):
+  seconds = parsetime(datestring)
+  if seconds is None:
+    raise Gpx2psError("date '%s' could not be parsed.  Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS" % datestring)
+  return seconds
 
 ##
 ## rgbhextofloat()
@@ -587,8 +4285,7 @@ def rgbhextofloat(rgb):
   result = re.search("^#(..)(..)(..)$", rgb)
 
   if result == None:
-    sys.stderr.write("Error: color string '%s' could not be parsed\n" % rgb)
-    sys.exit(1)
+    raise Gpx2psError("color string '%s' could not be parsed" % rgb)
 
   red = scale(int(result.group(1), 16), (0, 255), (0, 1))
   green = scale(int(result.group(2), 16), (0, 255), (0, 1))